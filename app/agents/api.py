@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 
 from http.client import HTTPException
 
@@ -10,8 +11,10 @@ from configs import apollo_config_chatService, dify_chat_url, dify_api_key, fold
 from configs import difyKBclient,dataset_metadata_kb_name
 import time
 import logging
+import logging.config
 
 from .agent_route import  query_route_by_scene_id
+from app.core.config import settings
 from .auth.auth import AuthMiddleware, get_current_user
 from .knowledge.knowledage_api import knowledage_router
 from .scene.agent_api import platform_router
@@ -22,15 +25,16 @@ from .start_up_init import  StartUp
 from .time_job.data_sync_timer import execute_sync_task, control_scheduler
 
 import json
-import requests
+import orjson
 import aiohttp
+from redis.asyncio import Redis
 
 from service.response import register_exception_handler, ApiException
 from service.routes.itsm import router as itsm_router
 from fastapi import FastAPI, Response, status, BackgroundTasks, Request
 
 from starlette.responses import StreamingResponse
-from DifyClient.client import ChatClient
+from fastapi.responses import ORJSONResponse
 from service.privilege import getAgentRoute
 from service.models import (
     ChatRequest,
@@ -56,19 +60,23 @@ from service.dictionary.dictionary_api import router as dictionary_router
 from service.ai_models.ai_models_api import router as ai_models_router
 from service.privilege import router as privilege_router
 
-logger = logging.getLogger("uvicorn.access")
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.handlers = [handler]
-
-logger = logging.getLogger("uvicorn.access")
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.handlers = [handler]
-
-app = FastAPI()
+# 日志统一配置：uvicorn 访问日志与本模块日志各挂一个处理器，不向上层重复输出
+logging.config.dictConfig({
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {"format": "%(asctime)s - %(levelname)s - %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    },
+    "loggers": {
+        "uvicorn.access": {"handlers": ["console"], "level": "INFO", "propagate": False},
+        __name__: {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+})
+
+app = FastAPI(default_response_class=ORJSONResponse)
 # 添加中间件
 app.add_middleware(AuthMiddleware,
     exclude_paths=[
@@ -103,17 +111,138 @@ app.include_router(ai_models_router, prefix="/bitmind/service/api/v1/ai_models")
 app.include_router(privilege_router, prefix="/bitmind/service/api/v1")
 
 logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
 
 default_scene_name = '通识问答'
+# 需要折叠深度思考过程的场景，导入时转为集合，按请求 O(1) 判断
+folded_thinking_process_set = frozenset(folded_thinking_process_list)
+
+# 后台任务队列容量、消费协程数量、入队等待及停机排空超时（秒）
+BG_QUEUE_MAXSIZE = 512
+BG_WORKER_COUNT = 8
+BG_PUT_TIMEOUT = 1
+BG_DRAIN_TIMEOUT = 10
+
+
+async def _background_worker(queue: asyncio.Queue):
+    while True:
+        fn, args = await queue.get()
+        try:
+            await fn(*args)
+        except Exception:
+            logger.exception(f"后台任务执行失败: {fn.__name__}")
+        finally:
+            queue.task_done()
+
+
+async def submit_background(fn, *args):
+    """
+    提交后台协程任务到有界队列
+
+    队列满时短暂等待形成背压，仍无法入队则记录日志并丢弃
+    """
+    try:
+        await asyncio.wait_for(app.state.bg_queue.put((fn, args)), timeout=BG_PUT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"后台任务队列已满，丢弃任务: {fn.__name__}{args}")
+
 
 @app.on_event("startup")
 async def start_up():
     # 系统初始化执行
     StartUp.init()
+    # 全局共享的 aiohttp 会话，复用连接池与 keep-alive，避免每个请求重新握手
+    app.state.aio_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=1000),
+        connector=aiohttp.TCPConnector(limit=0, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=75)
+    )
+    # 会话落库、摘要生成等后台任务走有界队列，避免无限制创建任务挤占流式请求
+    app.state.bg_queue = asyncio.Queue(maxsize=BG_QUEUE_MAXSIZE)
+    app.state.bg_workers = [asyncio.create_task(_background_worker(app.state.bg_queue))
+                            for _ in range(BG_WORKER_COUNT)]
+    # 场景路由等读多写少的元数据缓存
+    app.state.redis = Redis(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        db=settings.redis_db,
+        password=settings.redis_password if settings.redis_password else None,
+    )
+    app.state.visit_flusher = asyncio.create_task(_visit_count_flush_loop())
+
+
+@app.on_event("shutdown")
+async def shut_down():
+    visit_flusher = getattr(app.state, "visit_flusher", None)
+    if visit_flusher is not None:
+        visit_flusher.cancel()
+        await asyncio.gather(visit_flusher, return_exceptions=True)
+        # 停机前把 Redis 中累计的访问次数写回数据库
+        await flush_visit_counts()
+    bg_queue = getattr(app.state, "bg_queue", None)
+    if bg_queue is not None:
+        # 等待已入队的任务执行完，超时后直接取消
+        try:
+            await asyncio.wait_for(bg_queue.join(), timeout=BG_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"后台任务未在 {BG_DRAIN_TIMEOUT}s 内执行完，剩余 {bg_queue.qsize()} 个任务被丢弃")
+        for worker in app.state.bg_workers:
+            worker.cancel()
+        await asyncio.gather(*app.state.bg_workers, return_exceptions=True)
+    session = getattr(app.state, "aio_session", None)
+    if session is not None:
+        await session.close()
+    redis_client = getattr(app.state, "redis", None)
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+# 场景路由缓存过期时间（秒）
+SCENE_ROUTE_CACHE_TTL = 300
+
+
+def _scene_route_cache_key(scene_id) -> str:
+    return f"scene:route:{scene_id}"
+
+
+async def get_scene_route(scene_id):
+    """
+    根据 scene_id 获取场景绑定智能体的 (key, url)，优先读取 Redis 缓存
+
+    缓存不可用时直接回源数据库，不影响正常对话
+    """
+    redis_client = getattr(app.state, "redis", None)
+    cache_key = _scene_route_cache_key(scene_id)
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(cache_key)
+            if cached:
+                key, url = orjson.loads(cached)
+                return key, url
+        except Exception as e:
+            logger.warning(f"读取场景路由缓存失败: {e}")
+
+    key, url = await run_in_threadpool(query_route_by_scene_id, scene_id)
+
+    if redis_client is not None:
+        try:
+            await redis_client.set(cache_key, orjson.dumps((key, url)), ex=SCENE_ROUTE_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"写入场景路由缓存失败: {e}")
+    return key, url
+
+
+async def invalidate_scene_route(scene_id):
+    """
+    删除指定场景的路由缓存
+
+    由 scene_api 中场景更新/删除接口在写库成功后调用，避免按旧的智能体路由转发
+    """
+    redis_client = getattr(app.state, "redis", None)
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(_scene_route_cache_key(scene_id))
+    except Exception as e:
+        logger.warning(f"清除场景路由缓存失败: {e}")
 
 
 
@@ -196,23 +325,42 @@ async def chat_streaming(request:Request,req: ChatRequest, resp: Response,backgr
         resp.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         raise ValueError(f"APIError: {str(e)}")
 
+async def _ensure_conversation(req, user) -> str:
+    """获取会话id，新会话时生成id并异步落库、生成摘要"""
+    conversation_id = req.context.get("conversation_id")
+    if not conversation_id:
+        conversation_id = uuid.uuid4().hex
+        await submit_background(save_conversation_async, conversation_id, req.context.get("agent_id"),
+                                user.get("userId"), user.get("account"), req.context.get("isScene"))
+        # 启动异步线程，不阻塞后面的流程
+        await submit_background(gen_summary_async, conversation_id, req.question)
+    return conversation_id
+
+
+def _register_save(background_tasks, conversation_id, message_id, user, req, answers, thought):
+    """流结束后保存消息（BackgroundTasks 直接执行，不经过有界队列，保证不会被丢弃）"""
+    background_tasks.add_task(save_messages_async, conversation_id, message_id, user.get("userId"), req,
+                              answers, thought)
+
+
+def _streaming_response(response_generator, upstream_headers, status_code: int) -> StreamingResponse:
+    """包装成 StreamingResponse，透传上游 Content-Type 与响应头"""
+    return StreamingResponse(
+        response_generator,
+        status_code=status_code,
+        media_type=upstream_headers.get("Content-Type", "text/event-stream"),
+        headers=build_stream_headers(upstream_headers)
+    )
+
+
 """ 处理 agentFlow 平台智能体 """
 async def handle_agent_flow(background_tasks, req, user):
     # 捕获流聚合数据
     answers = []
     thought = []
-    userId = user.get("userId")
-    account = user.get("account")
-    agentId = req.context.get("agent_id")
 
     # 如果是新会话创建一条记录
-    conversation_id = req.context.get("conversation_id")
-    if not conversation_id:
-        conversation_id = uuid.uuid4().hex
-        asyncio.create_task(save_conversation_async(conversation_id, agentId, userId, account, req.context.get("isScene")))
-
-        # 启动异步线程，不阻塞后面的流程
-        asyncio.create_task(gen_summary_async(conversation_id, req.question))
+    conversation_id = await _ensure_conversation(req, user)
 
     # 从 scene 中获取 agent_name (agentFlow 需要的智能体名称),暂时使用apikey字段
     agent_name = req.context.get("scene", {}).get("apikey", "")
@@ -229,58 +377,242 @@ async def handle_agent_flow(background_tasks, req, user):
 
     base_url = req.context.get("scene", {}).get("base_url", "")
 
-    session = None
+    session = app.state.aio_session
     try:
-        timeout = aiohttp.ClientTimeout(total=1000)
-        session = aiohttp.ClientSession(timeout=timeout)
         response = await session.post(
             f"{base_url}/api/v1/agent/stream",
             json=agentflow_request
         )
         if response.status != 200:
             error_msg = await response.text()
-            await session.close()
+            response.release()
             raise Exception(f"Status: {response.status}, Error: {error_msg}")
             
     except Exception as e:
-        if session:
-            await session.close()
         logger.exception(f"调用 agentFlow 接口失败: {e}")
         raise ApiException(500, f"调用 agentFlow 接口失败: {str(e)}")
 
-    logger.info(f"agentFlow response content-type: {response.headers.get('Content-Type')}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"agentFlow response content-type: {response.headers.get('Content-Type')}")
 
     # 消息id
     message_id = uuid.uuid4().hex
 
     # 生成流式响应
-    response_generator = agentflow_stream_generator(response, session, answers, thought, conversation_id, message_id)
+    response_generator = agentflow_stream_generator(response, answers, thought, conversation_id, message_id)
 
-    # 构建响应头
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",  # 禁用nginx缓冲
-        "Content-Encoding": "identity"  # 禁用压缩
+    # 将异步保存消息任务添加到后台任务
+    _register_save(background_tasks, conversation_id, message_id, user, req, answers, thought)
+
+    return _streaming_response(response_generator, response.headers, response.status)
+
+
+# 合并写出阈值：单次读取内积累的帧超过该大小时提前写出
+SSE_FLUSH_BYTES = 4096
+
+
+async def iter_sse_batches(content: aiohttp.StreamReader):
+    """
+    按字节解析 SSE 流，每次网络读取产出一批完整事件 [(event_type, data), ...]
+
+    - 以空行 (b"\n\n") 切分事件，只对 data 部分解码一次
+    - event_type 为 bytes，没有 event 字段时为 None
+    - 注释行 (":" 开头) 和未知字段直接忽略
+    - 按读取批次产出，调用方可以把同一批次的帧合并后一次写出
+    """
+    buf = bytearray()
+    async for chunk in content.iter_any():
+        buf += chunk
+        events = []
+        while (idx := buf.find(b"\n\n")) != -1:
+            event = bytes(buf[:idx])
+            del buf[:idx + 2]
+            parsed = _parse_sse_event(event)
+            if parsed is not None:
+                events.append(parsed)
+        if events:
+            yield events
+    # 流结束时处理最后一个未以空行结尾的事件
+    if buf.strip():
+        parsed = _parse_sse_event(bytes(buf))
+        if parsed is not None:
+            yield [parsed]
+
+
+async def iter_stream_lines(content: aiohttp.StreamReader):
+    """
+    按行迭代上游响应，产出的每行保留结尾的 b"\n"，与直接迭代 StreamReader 一致
+
+    StreamReader 自带的按行迭代受读缓冲上限约束，单行超过约 128KiB（如大段 answer 或引用）
+    会抛出 ValueError("Chunk too big")；这里基于 iter_any() 自行切分，行长度不受限制
+    """
+    buf = bytearray()
+    async for chunk in content.iter_any():
+        buf += chunk
+        start = 0
+        while (idx := buf.find(b"\n", start)) != -1:
+            yield bytes(buf[start:idx + 1])
+            start = idx + 1
+        if start:
+            del buf[:start]
+    # 流结束时产出最后一个不以换行结尾的行
+    if buf:
+        yield bytes(buf)
+
+
+# 上游读取队列容量：客户端消费慢时读取任务在此阻塞，形成背压
+UPSTREAM_QUEUE_MAXSIZE = 64
+_UPSTREAM_EOF = object()
+
+
+async def _pump_upstream_lines(content: aiohttp.StreamReader, queue: asyncio.Queue):
+    """读取任务：逐行读取上游响应放入队列，正常结束时放入结束标记，异常原样转交给消费方"""
+    try:
+        async for raw in iter_stream_lines(content):
+            await queue.put(raw)
+    except Exception as e:
+        await queue.put(e)
+    else:
+        await queue.put(_UPSTREAM_EOF)
+
+
+async def iter_upstream_lines(content: aiohttp.StreamReader):
+    """
+    以生产者/消费者方式迭代上游的行
+
+    - 读取由独立任务完成，与下游 SSE 生成解耦
+    - 队列有界，下游阻塞时上游读取随之暂停
+    - 消费方提前退出时取消读取任务；调用方需用 contextlib.aclosing 包裹，确保断连时立即清理
+    """
+    queue = asyncio.Queue(maxsize=UPSTREAM_QUEUE_MAXSIZE)
+    reader = asyncio.create_task(_pump_upstream_lines(content, queue))
+    try:
+        while (item := await queue.get()) is not _UPSTREAM_EOF:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        reader.cancel()
+        # 等待读取任务真正退出后再返回，保证调用方释放连接时已无任务在读取 content
+        await asyncio.gather(reader, return_exceptions=True)
+
+
+# orjson 序列化选项只定义一次；允许非字符串键，与 json.dumps 行为保持一致
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+
+def _sse(obj, conversation_id=None, message_id=None) -> bytes:
+    """按 SSE 格式编码一帧，orjson 直接输出 UTF-8 bytes，StreamingResponse 无需再 encode
+
+    传入 conversation_id / message_id 时在序列化前一并写入帧中
+    """
+    if conversation_id is not None:
+        obj["conversation_id"] = conversation_id
+    if message_id is not None:
+        obj["message_id"] = message_id
+    return b"data: " + orjson.dumps(obj, option=_ORJSON_OPTS) + b"\n\n"
+
+
+# 流式响应固定附带的头：禁用缓存、nginx 缓冲与压缩
+_BASE_STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Content-Encoding": "identity",
+}
+# 透传上游响应头时需要排除的头（小写）
+_DROP_HEADERS = frozenset({"content-length", "content-encoding"})
+
+
+def build_stream_headers(upstream_headers) -> dict:
+    """合并固定流式响应头与上游响应头（排除可能引起问题的头）"""
+    return _BASE_STREAM_HEADERS | {k: v for k, v in upstream_headers.items() if k.lower() not in _DROP_HEADERS}
+
+
+def _flush_text_buf(text_buf: bytearray, answers: list):
+    """把缓冲的流式文本作为一条记录写入 answers，保持与结构化数据的先后顺序"""
+    if text_buf:
+        answers.append(text_buf.decode("utf-8"))
+        text_buf.clear()
+
+
+def _parse_sse_event(event: bytes):
+    event_type = None
+    data_lines = []
+    for line in event.split(b"\n"):
+        line = line.rstrip(b"\r")
+        if line.startswith(b"event:"):
+            event_type = line[6:].strip()
+        elif line.startswith(b"data:"):
+            data_lines.append(line[5:].strip())
+    if not data_lines:
+        return None
+    data = b"\n".join(data_lines)
+    if not data:
+        return None
+    return event_type, data
+
+
+def _agentflow_msg(conversation_id: str, message_id: str, **fields) -> dict:
+    """构建返回给前端的 agentFlow 消息"""
+    return {
+        "conversation_id": conversation_id,
+        "thread_id": conversation_id,
+        "message_id": message_id,
+        "agent": "agentflow",
+        **fields
     }
 
-    # 从原始响应中添加其他头（排除可能引起问题的头）
-    for k, v in response.headers.items():
-        if k.lower() not in ("content-length", "content-encoding"):
-            headers[k] = v
 
-    # 将异步保存消息任务添加到后台任务
-    background_tasks.add_task(save_messages_async, conversation_id, message_id, userId, req, answers, thought)
+def _on_agentflow_message(data_json, data, conversation_id, message_id, answers, text_buf):
+    # 流式文本消息
+    text_content = data_json.get("text", "") if isinstance(data_json, dict) else str(data_json)
+    if not text_content:
+        return None
+    # 累积答案用于保存
+    text_buf += text_content.encode("utf-8")
+    return _sse(_agentflow_msg(conversation_id, message_id, content=text_content, type="message"))
 
-    return StreamingResponse(
-        response_generator,
-        status_code=response.status,
-        media_type=response.headers.get("Content-Type", "text/event-stream"),
-        headers=headers
-    )
+
+def _on_agentflow_data(data_json, data, conversation_id, message_id, answers, text_buf):
+    # 结构化数据（如查询结果），直接保存上游原始 JSON 文本，避免再序列化一次
+    _flush_text_buf(text_buf, answers)
+    answers.append(data.decode("utf-8"))
+    return _sse(_agentflow_msg(conversation_id, message_id, data=data_json, type="data"))
+
+
+def _on_agentflow_metadata(data_json, data, conversation_id, message_id, answers, text_buf):
+    # 元数据（如思考过程、工具调用等）
+    return _sse(_agentflow_msg(conversation_id, message_id, context=data.decode("utf-8"), type="metadata"))
 
 
-async def agentflow_stream_generator(response, session, answers: list, thought: list,
+def _on_agentflow_done(data_json, data, conversation_id, message_id, answers, text_buf):
+    # 完成信号
+    output_msg = _agentflow_msg(conversation_id, message_id, type="done", finished=True)
+    output_msg["thread_id"] = data_json.get("thread_id", conversation_id)
+    return _sse(output_msg)
+
+
+def _on_agentflow_error(data_json, data, conversation_id, message_id, answers, text_buf):
+    # 错误信息
+    error_msg = data_json.get("error", "未知错误") if isinstance(data_json, dict) else str(data_json)
+    logger.error(f"conversation_id: {conversation_id}, agentFlow 返回错误: {error_msg}")
+    return _sse(_agentflow_msg(conversation_id, message_id, error=error_msg, type="error", finished=True))
+
+
+# agentFlow 事件类型 -> 处理函数，处理函数返回要写出的 SSE 帧（无需输出时返回 None）
+_AGENTFLOW_HANDLERS = {
+    b"message": _on_agentflow_message,
+    b"data": _on_agentflow_data,
+    b"metadata": _on_agentflow_metadata,
+    b"done": _on_agentflow_done,
+    b"error": _on_agentflow_error,
+}
+# 收到后结束流的事件类型
+_AGENTFLOW_TERMINAL_EVENTS = frozenset({b"done", b"error"})
+
+
+async def agentflow_stream_generator(response, answers: list, thought: list,
                                      conversation_id: str, message_id: str):
     """
     处理 agentFlow 返回的 SSE 流
@@ -293,156 +625,59 @@ async def agentflow_stream_generator(response, session, answers: list, thought:
     - event: error - 错误信息
     """
     logger.info(f"conversation_id: {conversation_id}, 开始处理 agentFlow 流式响应")
-
-    current_event_type = None
+    out = bytearray()
+    # 连续的文本片段先拼接在一块缓冲区里，遇到结构化数据或流结束时再整体写入 answers
+    text_buf = bytearray()
+    finished = False
 
     try:
-        async for line in response.content:
-            raw = line.decode('utf-8').strip()
-            if not raw or raw.startswith(":"):
-                # 注释行或空行，跳过
-                continue
-
-            # 解析 SSE 格式
-            if raw.startswith("event:"):
-                # 提取事件类型
-                current_event_type = raw.replace("event:", "").strip()
-                continue
-
-            if raw.startswith("data:"):
-                # 提取数据
-                data_str = raw.replace("data:", "").strip()
-
-                if not data_str:
+        async for events in iter_sse_batches(response.content):
+            for current_event_type, data in events:
+                handler = _AGENTFLOW_HANDLERS.get(current_event_type)
+                if handler is None:
                     continue
 
                 try:
-                    data_json = json.loads(data_str)
-                except json.JSONDecodeError:
+                    data_json = orjson.loads(data)
+                except orjson.JSONDecodeError:
                     # 如果不是 JSON，当作纯文本处理
-                    data_json = {"text": data_str}
-
-                # 根据事件类型处理数据
-                if current_event_type == "message":
-                    # 流式文本消息
-                    text_content = data_json.get("text", "") if isinstance(data_json, dict) else str(data_json)
-
-                    if text_content:
-                        # 构建返回给前端的消息格式
-                        output_msg = {
-                            "conversation_id": conversation_id,
-                            "thread_id": conversation_id,
-                            "message_id": message_id,
-                            "agent": "agentflow",
-                            "content": text_content,
-                            "type": "message"
-                        }
-
-                        # 累积答案用于保存
-                        answers.append(text_content)
-
-                        yield f"data: {json.dumps(output_msg, ensure_ascii=False)}\n\n"
-                        await asyncio.sleep(0)
-
-                elif current_event_type == "data":
-                    # 结构化数据（如查询结果）
-                    output_msg = {
-                        "conversation_id": conversation_id,
-                        "thread_id": conversation_id,
-                        "message_id": message_id,
-                        "agent": "agentflow",
-                        "data": data_json,
-                        "type": "data"
-                    }
-
-                    # 保存结构化数据
-                    answers.append(json.dumps(data_json, ensure_ascii=False))
-
-                    yield f"data: {json.dumps(output_msg, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)
-
-                elif current_event_type == "metadata":
-                    # 元数据（如思考过程、工具调用等）
-                    metadata_content = json.dumps(data_json, ensure_ascii=False)
-
-                    output_msg = {
-                        # 保存思考过程
-                        # thought.append(metadata_content.get("thought", ""))
-                        "conversation_id": conversation_id,
-                        "thread_id": conversation_id,
-                        "message_id": message_id,
-                        "agent": "agentflow",
-                        "context": metadata_content,
-                        "type": "metadata"
-                    }
-
-                    yield f"data: {json.dumps(output_msg, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)
-
-                elif current_event_type == "done":
-                    # 完成信号
-                    output_msg = {
-                        "conversation_id": conversation_id,
-                        "thread_id": conversation_id,
-                        "message_id": message_id,
-                        "agent": "agentflow",
-                        "thread_id": data_json.get("thread_id", conversation_id),
-                        "type": "done",
-                        "finished": True
-                    }
-
-                    yield f"data: {json.dumps(output_msg, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)
-                    break
+                    data_json = {"text": data.decode("utf-8")}
 
-                elif current_event_type == "error":
-                    # 错误信息
-                    error_msg = data_json.get("error", "未知错误") if isinstance(data_json, dict) else str(data_json)
-                    logger.error(f"conversation_id: {conversation_id}, agentFlow 返回错误: {error_msg}")
-
-                    output_msg = {
-                        "conversation_id": conversation_id,
-                        "thread_id": conversation_id,
-                        "message_id": message_id,
-                        "agent": "agentflow",
-                        "error": error_msg,
-                        "type": "error",
-                        "finished": True
-                    }
-
-                    yield f"data: {json.dumps(output_msg, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)
+                frame = handler(data_json, data, conversation_id, message_id, answers, text_buf)
+                if frame:
+                    out += frame
+                if current_event_type in _AGENTFLOW_TERMINAL_EVENTS:
+                    finished = True
                     break
 
-                # 重置事件类型
-                current_event_type = None
+                if len(out) >= SSE_FLUSH_BYTES:
+                    yield bytes(out)
+                    out.clear()
+
+            # 同一次读取到的帧合并写出，减少 ASGI send 次数
+            if out:
+                yield bytes(out)
+                out.clear()
+            if finished:
+                break
 
     except Exception as e:
         logger.exception(f"conversation_id: {conversation_id}, agentFlow 流处理异常")
-        error_msg = {
-            "conversation_id": conversation_id,
-            "thread_id": conversation_id,
-            "message_id": message_id,
-            "agent": "agentflow",
-            "error": f"流处理异常: {str(e)}",
-            "type": "error",
-            "finished": True
-        }
-        yield f"data: {json.dumps(error_msg, ensure_ascii=False)}\n\n"
+        error_msg = _agentflow_msg(conversation_id, message_id, error=f"流处理异常: {str(e)}", type="error",
+                                   finished=True)
+        out += _sse(error_msg)
+        yield bytes(out)
     finally:
+        _flush_text_buf(text_buf, answers)
+        # 会话为全局共享，这里只释放连接回连接池
         if response:
             response.release()
-        if session:
-            await session.close()
 
 """处理 dify 平台智能体"""
 async def handle_dify(background_tasks, req,user):
     # 捕获流聚合数据
     answers = []
     thought = []
-    userId = user.get("userId")
-    account = user.get("account")
-    agentId = req.context.get("agent_id")
     scene_name = req.context["scene"].get("scene_name")
     '''
         hasPrivilege = checkUserPrivilege(userId, agentId)
@@ -459,63 +694,63 @@ async def handle_dify(background_tasks, req,user):
             )
         '''
     # 如果是新会话创建一条记录
-    conversation_id = req.context.get("conversation_id")
-    if not conversation_id:
-        conversation_id = uuid.uuid4().hex
-        asyncio.create_task(
-            save_conversation_async(conversation_id, agentId, userId, account, req.context.get("isScene")))
-        # try:
-        #     save_conversation(new_conversation_id, agentId, userId,account, req.context.get("isScene"))
-        # except Exception as e:
-        #     print(f"保存会话时出错: {e}")
-
-        # 启动异步线程，不阻塞后面的流程
-        asyncio.create_task(gen_summary_async(conversation_id,req.question))
+    conversation_id = await _ensure_conversation(req, user)
 
     #  根据scene_id 查找对应场景绑定的智能体的url和key
-    key, url = query_route_by_scene_id(req.context.get("scene").get("id"))
-    chatClient = ChatClient(key, url)
-
+    key, url = await get_scene_route(req.context.get("scene").get("id"))
 
     userName = user.get("realname")
 
-    completion_response = chatClient.create_chat_message(
+    completion_response = await create_chat_message_async(
+        app.state.aio_session,
+        key,
+        url,
         inputs=req.context,
         query=req.question,
         user=userName,
         response_mode="streaming")
-    completion_response.raise_for_status()
-
-    print("dify response content-type: {}".format(completion_response.headers.get("Content-Type")))
-    # 构建响应头
-    headers = {}
-    # 添加禁用缓冲的头
-    headers["Cache-Control"] = "no-cache"
-    headers["Connection"] = "keep-alive"
-    headers["X-Accel-Buffering"] = "no"  # 禁用nginx缓冲
-    headers["Content-Encoding"] = "identity"  # 禁用压缩
-
-    # 从原始响应中添加其他头（排除可能引起问题的头）
-    for k, v in completion_response.headers.items():
-        if k.lower() not in ("content-length", "content-encoding"):
-            headers[k] = v
+
+    logger.debug("dify response content-type: %s", completion_response.headers.get("Content-Type"))
 
     # 消息id
     message_id = uuid.uuid4().hex
     # 包装成 StreamingResponse，透传 Content-Type
-    folded_thinking_process = True if scene_name in folded_thinking_process_list else False
+    folded_thinking_process = scene_name in folded_thinking_process_set
     response_generator = dify_stream_generator(completion_response, answers, thought, conversation_id, message_id,
                                                folded_thinking_process)
-    streaming_response = StreamingResponse(
-        response_generator,
-        status_code=completion_response.status_code,
-        media_type=completion_response.headers.get("Content-Type", "text/event-stream"),
-        headers=headers
-    )
 
     # 将异步保存消息任务添加到后台任务
-    background_tasks.add_task(save_messages_async, conversation_id, message_id, userId, req, answers,thought)
-    return streaming_response
+    _register_save(background_tasks, conversation_id, message_id, user, req, answers, thought)
+    return _streaming_response(response_generator, completion_response.headers, completion_response.status)
+
+
+async def create_chat_message_async(session: aiohttp.ClientSession, api_key: str, base_url: str, inputs: dict,
+                                    query: str, user: str, response_mode: str = "streaming",
+                                    conversation_id: str = None, files: list = None) -> aiohttp.ClientResponse:
+    """
+    dify ChatClient.create_chat_message 的异步版本，基于 aiohttp 调用 dify 的 /chat-messages 接口
+
+    返回未读取的 aiohttp.ClientResponse，由调用方负责消费并 release
+    """
+    data = {
+        "inputs": inputs,
+        "query": query,
+        "user": user,
+        "response_mode": response_mode,
+        "files": files
+    }
+    if conversation_id:
+        data["conversation_id"] = conversation_id
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    response = await session.post(f"{base_url}/chat-messages", json=data, headers=headers)
+    if response.status >= 400:
+        error_msg = await response.text()
+        response.release()
+        raise ApiException(response.status, f"调用 dify 接口失败: {error_msg}")
+    return response
 
 
 """ 处理 uyun 平台智能体 """
@@ -530,8 +765,7 @@ async def handle_uyun(background_tasks, req, resp, user):
     conversation_id = req.context.get("conversation_id")
     if not conversation_id:
         conversation_id = uuid.uuid4().hex
-    asyncio.create_task(
-            save_conversation_async(conversation_id, agentId, userId, account, req.context.get("isScene")))
+    await submit_background(save_conversation_async, conversation_id, agentId, userId, account, req.context.get("isScene"))
         # try:
         #     save_conversation(conversation_id, agentId, userId,account, req.context.get("isScene"))
         # except Exception as e:
@@ -539,166 +773,57 @@ async def handle_uyun(background_tasks, req, resp, user):
 
         # 启动异步线程，不阻塞后面的流程
     logger.info(f"摘要生成开始: {conversation_id}")
-    asyncio.create_task(gen_summary_async(conversation_id, req.question))
+    await submit_background(gen_summary_async, conversation_id, req.question)
 
     req.context["conversation_id"] = conversation_id
-    completion_response = engingService(req, resp,userId)
+    completion_response = await engingService(req, resp,userId)
     # 消息id
     message_id = uuid.uuid4().hex
     response_generator = multi_agent_stream_generator(completion_response, answers,thought, conversation_id, message_id)
     # 将异步保存消息任务添加到后台任务
-    background_tasks.add_task(save_messages_async, conversation_id, message_id, userId, req, answers,thought)
-    # 构建响应头
-    headers = {}
-    # 添加禁用缓冲的头
-    headers["Cache-Control"] = "no-cache"
-    headers["Connection"] = "keep-alive"
-    headers["X-Accel-Buffering"] = "no"  # 禁用nginx缓冲
-    headers["Content-Encoding"] = "identity"  # 禁用压缩
-
-    # 从原始响应中添加其他头（排除可能引起问题的头）
-    for k, v in completion_response.headers.items():
-        if k.lower() not in ("content-length", "content-encoding"):
-            headers[k] = v
+    _register_save(background_tasks, conversation_id, message_id, user, req, answers, thought)
 
-    return StreamingResponse(
-        response_generator,
-        status_code=completion_response.status_code,
-        media_type=completion_response.headers.get("Content-Type", "text/event-stream"),
-        headers=headers
-    )
+    return _streaming_response(response_generator, completion_response.headers, completion_response.status)
 
 
 """ 处理默认逻辑"""
-# async def handle_default(background_tasks, req,user):
-#     # 捕获流聚合数据
-#     answers = []
-#     thought = []
-#     userId = user.get("userId")
-#     account = user.get("account")
-#
-#     agentId = req.context.get("agent_id")
-#     # 如果是新会话创建一条记录
-#     conversation_id = req.context.get("conversation_id")
-#     if not conversation_id:
-#         conversation_id = uuid.uuid4().hex
-#         asyncio.create_task(
-#             save_conversation_async(conversation_id, agentId, userId, account, req.context.get("isScene")))
-#         # try:
-#         #     save_conversation(new_conversation_id, agentId, userId,account, req.context.get("isScene"))
-#         # except Exception as e:
-#         #     print(f"保存会话时出错: {e}")
-#
-#         # 启动异步线程，不阻塞后面的流程
-#         asyncio.create_task(gen_summary_async(conversation_id, req.question))
-#
-#     chatClient = ChatClient(dify_api_key, dify_chat_url)
-#
-#     userName = user.get("realname")
-#
-#     completion_response = chatClient.create_chat_message(
-#         inputs={'context': json.dumps(req.context, ensure_ascii=False)},
-#         query=req.question,
-#         user=userName,
-#         response_mode="streaming")
-#     completion_response.raise_for_status()
-#
-#     logger.debug(f"dify response content-type: {completion_response.headers.get('Content-Type')}")
-#     # 消息id
-#     message_id = uuid.uuid4().hex
-#     # 包装成 StreamingResponse，透传 Content-Type
-#     response_generator = dify_stream_generator(completion_response, answers,thought, conversation_id, message_id)
-#
-#     # 构建响应头
-#     headers = {}
-#     # 添加禁用缓冲的头
-#     headers["Cache-Control"] = "no-cache"
-#     headers["Connection"] = "keep-alive"
-#     headers["X-Accel-Buffering"] = "no"  # 禁用nginx缓冲
-#     headers["Content-Encoding"] = "identity"  # 禁用压缩
-#
-#     # 从原始响应中添加其他头（排除可能引起问题的头）
-#     for k, v in completion_response.headers.items():
-#         if k.lower() not in ("content-length", "content-encoding"):
-#             headers[k] = v
-#
-#     streaming_response = StreamingResponse(
-#         response_generator,
-#         status_code=completion_response.status_code,
-#         media_type=completion_response.headers.get("Content-Type", "text/event-stream"),
-#         headers=headers
-#     )
-#
-#     # 将异步保存消息任务添加到后台任务
-#     background_tasks.add_task(save_messages_async, conversation_id, message_id, userId, req, answers,thought)
-#     return streaming_response
-
 async def handle_default(background_tasks, req,user):
     # 捕获流聚合数据
     answers = []
     thought = []
-    userId = user.get("userId")
-    account = user.get("account")
 
-    agentId = req.context.get("agent_id")
     # 如果是新会话创建一条记录
-    conversation_id = req.context.get("conversation_id")
-    if not conversation_id:
-        conversation_id = uuid.uuid4().hex
-        asyncio.create_task(
-            save_conversation_async(conversation_id, agentId, userId, account, req.context.get("isScene")))
-        # try:
-        #     save_conversation(new_conversation_id, agentId, userId,account, req.context.get("isScene"))
-        # except Exception as e:
-        #     print(f"保存会话时出错: {e}")
-
-        # 启动异步线程，不阻塞后面的流程
-        asyncio.create_task(gen_summary_async(conversation_id, req.question))
-
-    chatClient = ChatClient(dify_api_key, dify_chat_url)
+    conversation_id = await _ensure_conversation(req, user)
 
     userName = user.get("realname")
 
-    completion_response = chatClient.create_chat_message(
-        inputs={'context': json.dumps(req.context, ensure_ascii=False)},
+    completion_response = await create_chat_message_async(
+        app.state.aio_session,
+        dify_api_key,
+        dify_chat_url,
+        inputs={'context': orjson.dumps(req.context, option=_ORJSON_OPTS).decode("utf-8")},
         query=req.question,
         user=userName,
         response_mode="streaming")
-    completion_response.raise_for_status()
 
-    logger.debug(f"dify response content-type: {completion_response.headers.get('Content-Type')}")
+    logger.debug("dify response content-type: %s", completion_response.headers.get("Content-Type"))
     # 消息id
     message_id = uuid.uuid4().hex
     # 包装成 StreamingResponse，透传 Content-Type
     response_generator = dify_stream_generator(completion_response, answers,thought, conversation_id, message_id)
 
-    # 构建响应头
-    headers = {}
-    # 添加禁用缓冲的头
-    headers["Cache-Control"] = "no-cache"
-    headers["Connection"] = "keep-alive"
-    headers["X-Accel-Buffering"] = "no"  # 禁用nginx缓冲
-    headers["Content-Encoding"] = "identity"  # 禁用压缩
+    # 将异步保存消息任务添加到后台任务
+    _register_save(background_tasks, conversation_id, message_id, user, req, answers, thought)
+    return _streaming_response(response_generator, completion_response.headers, completion_response.status)
 
-    # 从原始响应中添加其他头（排除可能引起问题的头）
-    for k, v in completion_response.headers.items():
-        if k.lower() not in ("content-length", "content-encoding"):
-            headers[k] = v
 
-    streaming_response = StreamingResponse(
-        response_generator,
-        status_code=completion_response.status_code,
-        media_type=completion_response.headers.get("Content-Type", "text/event-stream"),
-        headers=headers
-    )
-
-    # 将异步保存消息任务添加到后台任务
-    background_tasks.add_task(save_messages_async, conversation_id, message_id, userId, req, answers,thought)
-    return streaming_response
+def _read_text_file(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
 
 
 @app.post("/api/v1/read_file")
-def read_file() -> dict:
+async def read_file() -> dict:
     """
     读取指定路径的文件内容并返回。
 
@@ -712,65 +837,106 @@ def read_file() -> dict:
     metadata_path = os.path.abspath(metadata_path)  # 确保路径是绝对的
 
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+        content = await run_in_threadpool(_read_text_file, metadata_path)
         return {"status": "success", "content": content}
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="文件未找到")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"读取文件时发生错误: {str(e)}")
 
+# 知识库分段数据缓存过期时间（秒）
+KB_SEGMENTS_CACHE_TTL = 60
+
+
+def _kb_segments_cache_key() -> str:
+    return f"kb:segments:{dataset_metadata_kb_name}"
+
+
 @app.get("/api/v1/segments_by_kb")
-def read_file() -> str:
+async def read_file() -> ORJSONResponse:
+    headers = {"Cache-Control": f"public, max-age={KB_SEGMENTS_CACHE_TTL}"}
+    redis_client = getattr(app.state, "redis", None)
+    cache_key = _kb_segments_cache_key()
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(cache_key)
+            if cached:
+                return ORJSONResponse(content=cached.decode("utf-8"), headers=headers)
+        except Exception as e:
+            logger.warning(f"读取知识库分段缓存失败: {e}")
+
     content = ""
     try:
-     content  = difyKBclient.get_dify_document_segments(dataset_metadata_kb_name)
-     return  content
+     content  = await run_in_threadpool(difyKBclient.get_dify_document_segments, dataset_metadata_kb_name)
     except Exception as e:
-        print(f"服务错误，分段数据未获取: {str(e)}")
+        logger.error("服务错误，分段数据未获取: %s", e)
         return  content
 
+    if content and redis_client is not None:
+        try:
+            await redis_client.set(cache_key, content, ex=KB_SEGMENTS_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"写入知识库分段缓存失败: {e}")
+    return ORJSONResponse(content=content, headers=headers)
+
+
+@app.delete("/api/v1/segments_by_kb/cache")
+async def clear_segments_cache() -> dict:
+    """知识库内容变更后清除分段数据缓存"""
+    redis_client = getattr(app.state, "redis", None)
+    if redis_client is not None:
+        try:
+            await redis_client.delete(_kb_segments_cache_key())
+        except Exception as e:
+            logger.warning(f"清除知识库分段缓存失败: {e}")
+            return {"status": "failed", "message": f"清除缓存失败: {e}"}
+    return {"status": "success"}
+
 
 
 @app.post("/api/v1/task/execute", response_model=TaskResponse)
-def execute_task(req: JobControlRequest) -> TaskResponse:
+async def execute_task(req: JobControlRequest) -> ORJSONResponse:
     """立即执行一次数据同步任务"""
-    success = execute_sync_task(req.job_type)
+    # 同步任务为阻塞调用，放到线程池执行，避免阻塞事件循环
+    success = await run_in_threadpool(execute_sync_task, req.job_type)
 
+    # 返回内容本身可直接序列化，直接构造响应跳过 jsonable_encoder
     if success:
-        return TaskResponse(
+        result = TaskResponse(
             status_code=status.HTTP_200_OK,
             content={"message": "任务执行成功"}
         )
     else:
-        return TaskResponse(
+        result = TaskResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"message": "任务执行失败"}
         )
+    return ORJSONResponse(content=result.model_dump())
 
 
 @app.post("/api/v1/task/control", response_model=TaskResponse)
-def control_task(req: JobControlRequest) -> TaskResponse:
+async def control_task(req: JobControlRequest) -> ORJSONResponse:
     """控制定时任务的启动与停止"""
     action = req.action
     job_type = req.job_type
-    result = control_scheduler(action,job_type)
+    result = await run_in_threadpool(control_scheduler, action, job_type)
 
     if not result["success"] and "无效的操作类型" in result["message"]:
-        return TaskResponse(
+        task_response = TaskResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": result["message"]}
         )
-    return TaskResponse(
-        status_code=status.HTTP_200_OK,
-        content={
-            "message": result["message"],
-            "status": result["status"]
-        }
-    )
+    else:
+        task_response = TaskResponse(
+            status_code=status.HTTP_200_OK,
+            content={
+                "message": result["message"],
+                "status": result["status"]
+            }
+        )
+    return ORJSONResponse(content=task_response.model_dump())
 
 import os
-import requests
 
 
 
@@ -804,6 +970,74 @@ import requests
 #         resp.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
 #         raise ValueError(f"APIError: {str(e)}")
 
+# 场景访问次数计数器前缀及回写数据库间隔（秒）
+SCENE_VISIT_KEY_PREFIX = "scene:visits:"
+SCENE_VISIT_FLUSH_INTERVAL = 30
+
+
+async def incr_scene_visit(scene_id):
+    """
+    场景访问次数先在 Redis 中累加，由后台定时批量写回数据库
+
+    Redis 不可用时退回到逐次更新数据库
+    """
+    redis_client = getattr(app.state, "redis", None)
+    if redis_client is not None:
+        try:
+            await redis_client.incr(f"{SCENE_VISIT_KEY_PREFIX}{scene_id}")
+            return
+        except Exception as e:
+            logger.warning(f"场景访问次数计数失败，直接更新数据库: {e}")
+    await submit_background(update_visit_count_async, scene_id)
+
+
+def _apply_visit_count(scene_id, count: int) -> int:
+    """
+    在同一个线程里为单个场景执行 count 次 +1 更新，返回实际成功的次数
+
+    scene_dao 只提供单次 +1 的更新，中途失败时停止并返回已成功的次数，由调用方把剩余次数退回 Redis
+    """
+    for applied in range(count):
+        try:
+            update_visit_count(scene_id)
+        except Exception as e:
+            logger.error(f"场景访问次数回写失败: scene_id={scene_id}, 已回写 {applied}/{count}, {e}")
+            return applied
+    return count
+
+
+async def flush_visit_counts():
+    """
+    读取并清零 Redis 中的场景访问次数，按场景写回数据库
+
+    每轮把取出的次数全部回写；写库失败时未回写的次数用 INCRBY 退回 Redis，留到下一轮，不会丢失计数
+    """
+    redis_client = getattr(app.state, "redis", None)
+    if redis_client is None:
+        return
+    counts = {}
+    async for key in redis_client.scan_iter(match=f"{SCENE_VISIT_KEY_PREFIX}*", count=500):
+        value = await redis_client.getdel(key)
+        if value:
+            counts[key] = int(value)
+    for key, count in counts.items():
+        scene_id = key.decode("utf-8").removeprefix(SCENE_VISIT_KEY_PREFIX)
+        applied = await run_in_threadpool(_apply_visit_count, scene_id, count)
+        remaining = count - applied
+        if remaining:
+            await redis_client.incrby(key, remaining)
+        logger.info(f"场景访问次数回写: scene_id={scene_id}, 回写 {applied}, 退回 {remaining}")
+
+
+async def _visit_count_flush_loop():
+    while True:
+        await asyncio.sleep(SCENE_VISIT_FLUSH_INTERVAL)
+        try:
+            await flush_visit_counts()
+        except Exception:
+            logger.exception("场景访问次数回写任务异常")
+
+
 async def update_visit_count_async(scene_id):
     """异步修改访问次数"""
     try:
@@ -815,7 +1049,7 @@ async def update_visit_count_async(scene_id):
     except Exception as e:
         logger.error(f"场景访问次数更新失败: {e}")
 
-def engingService(req:ChatRequest,resp:Response,userId) -> requests.Response:
+async def engingService(req:ChatRequest,resp:Response,userId) -> aiohttp.ClientResponse:
     agentId = None
     if req.context.get("agent_id"):
         agentId = req.context.get("agent_id")
@@ -833,9 +1067,8 @@ def engingService(req:ChatRequest,resp:Response,userId) -> requests.Response:
             scene_preference = req.context.get("scene").get("scene_preference")
 
         scene_id = req.context.get("scene", {}).get("id")
-        # 启动异步线程，不阻塞后面的流程
-        logger.info("开始异步更新")
-        asyncio.create_task(update_visit_count_async(scene_id))
+        # 访问次数在 Redis 中累加，定时回写数据库
+        await incr_scene_visit(scene_id)
 
 
 
@@ -849,46 +1082,49 @@ def engingService(req:ChatRequest,resp:Response,userId) -> requests.Response:
         }
     base_url = apollo_config_chatService.get("uyun.baseurl")
 
-    response = requests.request(
-        "POST",
+    # 复用全局 aiohttp 会话，返回未读取的响应，由流生成器消费并 release
+    response = await app.state.aio_session.post(
         f"{base_url}/bitmind/engine/api/chat/stream",
         json=json_data,
-        stream=True,
-        timeout=3000,
-        verify=False
+        timeout=aiohttp.ClientTimeout(total=3000),
+        ssl=False
     )
     response.raise_for_status()
     return response
-def DifyService(req: ChatRequest, resp: Response) -> ChatResponse:
+async def DifyService(req: ChatRequest, resp: Response) -> ChatResponse:
     """
         Dify
         """
-    print("DifyEngine")
+    logger.debug("DifyEngine")
     try:
         agentId = req.context.get("agent_id")
-        (url, key) = getAgentRoute(agentId)
-        chatClient = ChatClient(key, url)
+        (url, key) = await run_in_threadpool(getAgentRoute, agentId)
         # print("receive context:")
         # print(req.context)
         userName = req.context.get("userInfo", {}).get("realname", "None")
-        completion_response = chatClient.create_chat_message(
-            inputs={'context': json.dumps(req.context, ensure_ascii=False)},
-            query=req.question,
-            user=userName,
-            response_mode="blocking")
-        if completion_response.status_code == 400:
-            print("请求参数错误，将忽略")
-            return ChatResponse(status_code=200, message="")
-
-
-
-        completion_response.raise_for_status()
-        result = completion_response.json()
+        # 复用全局 aiohttp 会话调用 dify 阻塞模式接口，不占用事件循环
+        async with app.state.aio_session.post(
+            f"{url}/chat-messages",
+            json={
+                "inputs": {'context': orjson.dumps(req.context, option=_ORJSON_OPTS).decode("utf-8")},
+                "query": req.question,
+                "user": userName,
+                "response_mode": "blocking",
+                "files": None
+            },
+            headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+        ) as completion_response:
+            if completion_response.status == 400:
+                logger.warning("请求参数错误，将忽略")
+                return ChatResponse(status_code=200, message="")
+
+            completion_response.raise_for_status()
+            result = orjson.loads(await completion_response.read())
         try:
             answer = result.get('answer')
             answer = json.loads(answer)
             if not isinstance(answer, dict):
-                print("非字典类型")
+                logger.debug("非字典类型")
                 data = json.loads(answer.replace("'", '"'))
                 if isinstance(data, list):
                     return ChatResponse(status_code=200, content=data)
@@ -915,7 +1151,7 @@ def DifyService(req: ChatRequest, resp: Response) -> ChatResponse:
             error_message=f"获取回答异常，{str(e)}",
         )
 
-async def multi_agent_stream_generator(response: requests.Response, answers: list,thought:list, conversation_id: str,
+async def multi_agent_stream_generator(response: aiohttp.ClientResponse, answers: list,thought:list, conversation_id: str,
                                        message_id: str):
     thought_list = []
     planner_step_card_sent = False
@@ -932,106 +1168,98 @@ async def multi_agent_stream_generator(response: requests.Response, answers: lis
     coordinator_feedback = {"conversation_id": conversation_id, "message_id": message_id, "agent": "coordinator",
                             "content": "","type":"loading","loadingText":"识别用户意图..."}
 
-    yield f"data: {json.dumps(coordinator_feedback, ensure_ascii=False)}\n\n"
-    await asyncio.sleep(0)  # 强制刷新
+    yield _sse(coordinator_feedback)
     # time.sleep(1)
-    await handle_multi(answers,thought, conversation_id, coordinator_feedback, message_id)
+    handle_multi(answers,thought, conversation_id, coordinator_feedback, message_id)
     logger.info(f"conversation_id: {conversation_id}->意图识别进行中:{coordinator_feedback}")
     try:
-        for raw in response.iter_lines(decode_unicode=True):
-            if "data" in raw:
-                line = raw.removeprefix("data:").strip()
-                line_json = json.loads(line)
-                thread_id = line_json.get("thread_id")
-                agent = line_json.get("agent")
-                # print(f">>>line_json:{line_json}")
-                finish_reason = line_json.get("finish_reason")
-                if agent == "coordinator" and (finish_reason == "tool_calls" or finish_reason == "stop"):
-                    is_coordinator_thought = True
-                if agent == "coordinator" and is_coordinator_thought == True and "content"  in line_json:
-                    # line_json["loadingText"] = "正在意图识别中...\n\n"+line_json["content"]
-                    content = line_json["content"]
-                    if "loading..." in content:
-                        answer_result = content.split("|")
-                        if len(answer_result) > 0:
-                            text = answer_result[1]
-                            line_json["content"] = ""
-                            line_json["type"] = "loading"
-                            texts = ""
-                            for char in text:
-                                texts += char
-                                line_json['loadingText'] = "识别用户意图...\n\n" + texts
-                                yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-                                # time.sleep(0.05)
-                            logger.info(f"conversation_id: {conversation_id}->意图识别:{texts}")
-                            await asyncio.sleep(0)  # 强制刷新
-                            await handle_multi(answers,thought, conversation_id, line_json, message_id)
-                            # if "content" not in line_json or line_json.get("content") == "\n\n":
-                            # time.sleep(3)
-                            logger.info(f"coordinator完成:{json.dumps(line_json, ensure_ascii=False)}")
-                            line_json["content"] = ""
-                            line_json["loadingText"] = "正在规划任务，请稍后......."
-                            logger.info(f"conversation_id: {conversation_id}->{line_json}")
-                            yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-                            await asyncio.sleep(0)  # 强制刷新
-                    else:
-                        yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-
-                if line_json.get("content") and "thought" in line_json.get("content"):
-
-
-                    content = line_json["content"].replace("thought", "")
-
-                    # 逐字符输出content内容
-                    del line_json["content"]
-                    line_json["thought"] = content + "\n\n\n"
-                    thought_list.append(line_json)
-                    thought.append(content+ "\n\n\n")
-
-                    for char in content:
-                        line_json["thought"] = char  # 每次输出一个字符到thought字段
-
-                        logger.info(f"thought result -->:{line_json}")
-                        yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-                        await asyncio.sleep(0.05)  # 添加小延迟以产生逐字效果
-
-                    # 添加进thought_list，最后保存至历史消息中
-
-                    # 删除原来的content字段
-                    await asyncio.sleep(0)
-                try:
-                    if  line_json.get("content") and "flag" in line_json.get("content"):
-                        content = line_json.get("content").replace("flag", "")
-                        line_json['content'] = content
-                        yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-
-                        await handle_multi(answers,thought, conversation_id, line_json, message_id)
-                    # elif line_json.get("content") and "thought" not in line_json.get("content"):
-                    #     # 处理其他普通content内容（不包含thought和flag的）
-                    #     await handle_multi(answers, thought, conversation_id, line_json, message_id)
-                    #     yield f"data: {json.dumps(line_json, ensure_ascii=False)}\n\n"
-                except Exception as e:
-                    print(f"错误了：{e}")
-                    logger.exception(e)
+        async with contextlib.aclosing(iter_upstream_lines(response.content)) as upstream_lines:
+            async for raw in upstream_lines:
+                # SSE 规范中 data 必须是行首前缀，前缀判断无需扫描整行
+                if raw.startswith(b"data:"):
+                    line = raw[5:].strip()
+                    line_json = orjson.loads(line)
+                    thread_id = line_json.get("thread_id")
+                    agent = line_json.get("agent")
+                    # print(f">>>line_json:{line_json}")
+                    finish_reason = line_json.get("finish_reason")
+                    # content 在下面的分支中可能被清空或删除，本地变量与 line_json 同步更新
+                    content = line_json.get("content")
+                    if agent == "coordinator" and (finish_reason == "tool_calls" or finish_reason == "stop"):
+                        is_coordinator_thought = True
+                    if agent == "coordinator" and is_coordinator_thought == True and "content"  in line_json:
+                        # line_json["loadingText"] = "正在意图识别中...\n\n"+line_json["content"]
+                        if "loading..." in content:
+                            answer_result = content.split("|")
+                            if len(answer_result) > 0:
+                                text = answer_result[1]
+                                line_json["content"] = content = ""
+                                line_json["type"] = "loading"
+                                # 意图识别结果整段下发，逐字展示交给前端
+                                line_json['loadingText'] = "识别用户意图...\n\n" + text
+                                yield _sse(line_json)
+                                logger.info(f"conversation_id: {conversation_id}->意图识别:{text}")
+                                handle_multi(answers,thought, conversation_id, line_json, message_id)
+                                # if "content" not in line_json or line_json.get("content") == "\n\n":
+                                # time.sleep(3)
+                                logger.info(f"coordinator完成:{orjson.dumps(line_json).decode('utf-8')}")
+                                line_json["content"] = ""
+                                line_json["loadingText"] = "正在规划任务，请稍后......."
+                                logger.info(f"conversation_id: {conversation_id}->{line_json}")
+                                yield _sse(line_json)
+                        else:
+                            yield _sse(line_json)
+
+                    if content and "thought" in content:
+
+
+                        thought_text = content.replace("thought", "")
+
+                        # 逐字符输出content内容
+                        del line_json["content"]
+                        content = None
+                        line_json["thought"] = thought_text + "\n\n\n"
+                        thought_list.append(line_json)
+                        thought.append(thought_text+ "\n\n\n")
+
+                        # 思考过程整段下发，不再逐字符输出并人为延迟
+                        line_json["thought"] = thought_text
+                        yield _sse(line_json)
+
+                        # 添加进thought_list，最后保存至历史消息中
+
+                        # 删除原来的content字段
+                    try:
+                        if  content and "flag" in content:
+                            content = content.replace("flag", "")
+                            line_json['content'] = content
+                            yield _sse(line_json)
+
+                            handle_multi(answers,thought, conversation_id, line_json, message_id)
+                        # elif line_json.get("content") and "thought" not in line_json.get("content"):
+                        #     # 处理其他普通content内容（不包含thought和flag的）
+                        #     handle_multi(answers, thought, conversation_id, line_json, message_id)
+                        #     yield _sse(line_json)
+                    except Exception as e:
+                        logger.exception("处理数据流出错")
 
     except Exception as e:
         logger.exception("流生成过程中发生异常")
         end_msg = {"thread_id": thread_id, "id": str(uuid.uuid4()), "role": "assistant",
                    "content": ""}
         logger.info(f"结束流：{end_msg}")
-        yield f"data: {json.dumps(end_msg, ensure_ascii=False)}\n\n"
+        yield _sse(end_msg)
     finally:
-        # thought_list = thought_list.join("\n")
-        line_json = {"thread_id": thread_id, "id": str(uuid.uuid4()), "role": "assistant",
-                   "thought": "\n"}
-        await handle_multi(answers,thought, conversation_id, line_json, message_id)
+        response.release()
+        # 结束时只需在思考过程末尾补一个换行，该帧不会下发，无需构造消息体和 id
+        thought.append("\n")
 
 
         # answers.append(thought_list.join("\n"))
 
 
 
-async def handle_multi(answers,thought, conversation_id, line_json, message_id):
+def handle_multi(answers,thought, conversation_id, line_json, message_id):
     ## 获取content字段作为历史消息
     if line_json.get("content"):
         answers.append(line_json.get("content"))
@@ -1044,100 +1272,94 @@ async def handle_multi(answers,thought, conversation_id, line_json, message_id):
 
 
 #生成流数据
-async def dify_stream_generator(response: requests.Response, answers: list,thought: list,conversation_id: str,message_id:str=None, folded_thinking_process:bool=False):
+async def dify_stream_generator(response: aiohttp.ClientResponse, answers: list,thought: list,conversation_id: str,message_id:str=None, folded_thinking_process:bool=False):
 
     step_one_topic = "识别用户意图..."
     coordinator_feedback = {"conversation_id": conversation_id, "message_id": message_id, "agent": "coordinator",
                             "content":"",
                             "loadingText": step_one_topic,"type":"loading"}
 
-    yield f"data: {json.dumps(coordinator_feedback, ensure_ascii=False)}\n\n"
-    await asyncio.sleep(0)  # 强制刷新
-    await handle_multi(answers,thought, conversation_id, coordinator_feedback, message_id)
+    yield _sse(coordinator_feedback)
+    handle_multi(answers,thought, conversation_id, coordinator_feedback, message_id)
     # time.sleep(1)
     logger.info(f"意图识别进行中:{coordinator_feedback}")
-    for raw in response.iter_lines(decode_unicode=True, delimiter="\n"):
+    text_buf = bytearray()
+    try:
+        async for line in iter_stream_lines(response.content):
+            raw = line.strip()
 
-        if not raw or raw.startswith(":"):
-            # 注释行或者空行：发送一个空行触发客户端心跳，也可跳过
-            #yield "\n"
-            continue
+            if not raw or raw.startswith(b":"):
+                # 注释行或者空行：发送一个空行触发客户端心跳，也可跳过
+                #yield "\n"
+                continue
 
-        line = raw.removeprefix("data:").strip()
-        if line == "ping":
-            # 心跳，可选地回应一个 comment 保持连接
-            #yield ": pong\n\n"
-            continue
+            line = raw.removeprefix(b"data:").strip()
+            if line == b"ping":
+                # 心跳，可选地回应一个 comment 保持连接
+                #yield ": pong\n\n"
+                continue
 
-        try:
-            payload = json.loads(line)
-        except json.JSONDecodeError:
-            # 如果不是合法 JSON，就当文本事件发出
-            #yield f"data: {line}\n\n"
-            continue
-        if payload.get("event") == "message" and "loading..." in payload.get("answer"):
-            coordinator_feedback['loadingText'] = payload.get("answer")
-            text =payload.get("answer")
-            answer_result =text.split("|")
-            if len(answer_result)>0:
-                texts = ""
-                for char in answer_result[2]:
-                    texts += char
-                    coordinator_feedback['loadingText'] = answer_result[1] + "\n\n" + texts
-                    yield f"data: {json.dumps(coordinator_feedback, ensure_ascii=False)}\n\n"
-                    # time.sleep(0.05)
-
-
-            # yield f"data: {json.dumps(coordinator_feedback, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0)  # 强制刷新
-            # time.sleep(3)
-            # coordinator_feedback = {"conversation_id": conversation_id, "message_id": message_id,
-            #                         "agent": "coordinator",
-            #                         "content": "",
-            #                         "loadingText": "数据处理中...", "type": "loading"}
-            #
-            # yield f"data: {json.dumps(coordinator_feedback, ensure_ascii=False)}\n\n"
-            # await asyncio.sleep(0)  # 强制刷新
-
-        # 这里只处理 event=message
-        if payload.get("event") == "message"  or payload.get("event")== "message_end" :
             try:
-                if "loading..." in payload.get("answer"):
-                    print(f"loading...{payload.get("answer")}")
-                else:
-                    # 按照 SSE 规范包装 data 字段，并以空行分隔
-                    # print(json.dumps(payload))
-
-                    # 获取answer字段保存作为会话历史
-                    if payload.get("answer"):
-                        answers.append(payload.get("answer"))
-
-                    # 适配知识库召回溯源信息
-                    if payload.get("metadata"):
-                        metadata = json.dumps(payload.get("metadata"), ensure_ascii=False)
-                        print("知识库召回溯源信息:", metadata)
-                        answers.append(metadata)
-                    if folded_thinking_process:
-                        payload["answer"] = "<details open> <summary>深度思考</summary>" + payload.get("answer")
-                        folded_thinking_process = False
-                    ## 如果是普通聊天助手/dify，需要返回conversation_id和message_id,
-                    # 供前端调用生成摘要接口和消息反馈接口
-                    payload['conversation_id'] = conversation_id
-                    payload['message_id'] = message_id
-                    yield f"data: {json.dumps(payload)}\n\n"
-            except Exception as e:
-                logger.warn("忽略数据流")
+                payload = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # 如果不是合法 JSON，就当文本事件发出
+                #yield f"data: {line}\n\n"
+                continue
+            event = payload.get("event")
+            answer = payload.get("answer")
+            if event == "message" and "loading..." in answer:
+                coordinator_feedback['loadingText'] = answer
+                answer_result =answer.split("|")
+                if len(answer_result)>0:
+                    # 整段下发，逐字展示交给前端
+                    coordinator_feedback['loadingText'] = answer_result[1] + "\n\n" + answer_result[2]
+                    yield _sse(coordinator_feedback)
+
+            # 这里只处理 event=message
+            if event == "message"  or event== "message_end" :
+                try:
+                    if "loading..." in answer:
+                        logger.debug("loading... %s", answer)
+                    else:
+                        # 按照 SSE 规范包装 data 字段，并以空行分隔
+                        # print(json.dumps(payload))
+
+                        # 获取answer字段保存作为会话历史
+                        if answer:
+                            text_buf += answer.encode("utf-8")
+
+                        # 适配知识库召回溯源信息
+                        metadata = payload.get("metadata")
+                        if metadata:
+                            metadata = orjson.dumps(metadata).decode("utf-8")
+                            logger.debug("知识库召回溯源信息: %s", metadata)
+                            _flush_text_buf(text_buf, answers)
+                            answers.append(metadata)
+                        if folded_thinking_process:
+                            payload["answer"] = "<details open> <summary>深度思考</summary>" + answer
+                            folded_thinking_process = False
+                        ## 如果是普通聊天助手/dify，需要返回conversation_id和message_id,
+                        # 供前端调用生成摘要接口和消息反馈接口
+                        yield _sse(payload, conversation_id, message_id)
+                except Exception as e:
+                    logger.warn("忽略数据流")
+    finally:
+        _flush_text_buf(text_buf, answers)
+        response.release()
+
+#开始工作流信号，内容固定，导入时序列化一次
+_START_FRAME = _sse({
+    "start": {
+        "code": 0,
+        "message": "start"
+    }
+})
+
 
 #流模式异常数据处理
 async def start_stream_generator():
      #开始工作流：
-    start_sign = {
-        "start": {
-            "code": 0,
-            "message": "start"
-        }
-    }
-    yield f"data: {json.dumps(start_sign)}\n\n"
+    yield _START_FRAME
 
 
 #流模式异常数据处理
@@ -1151,7 +1373,7 @@ async def error_stream_generator(message: str, code: int):
         "finished": True  # 标识流结束
     }
     # 按照SSE格式返回错误
-    yield f"data: {json.dumps(error_data)}\n\n"
+    yield _sse(error_data)
 
 
 
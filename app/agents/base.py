@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, AsyncGenerator, TYPE_CHECKING, Optional
+from typing import Dict, Any, AsyncGenerator, TYPE_CHECKING, Optional, Tuple
 from langgraph.graph import StateGraph
 from app.schemas.agent import AgentResponse
 import os
+import json
+import threading
 
 if TYPE_CHECKING:
     from app.core.container import ServiceContainer
@@ -15,6 +17,14 @@ class AgentBase(ABC):
     所有智能体都需要继承此基类并实现相关方法
     """
 
+    # 提示词文件缓存: 文件路径 -> (修改时间, 内容)，所有智能体共享
+    _prompt_cache: Dict[str, Tuple[float, str]] = {}
+    _prompt_cache_lock = threading.Lock()
+
+    # 编译后的图缓存: (智能体类, 服务容器, 配置签名) -> 编译后的图，同类同配置的实例共享
+    _graph_cache: Dict[Tuple[type, Any, str], Any] = {}
+    _graph_cache_lock = threading.Lock()
+
     def __init__(self, name: str, description: str):
         self.name = name
         self.description = description
@@ -38,12 +48,46 @@ class AgentBase(ABC):
         """
         pass
 
+    def _graph_cache_key(self) -> Tuple[type, Any, str]:
+        # 直接以容器对象作为键（而非 id()），避免容器被回收后 id 复用导致误命中
+        config_signature = json.dumps(self.config, sort_keys=True, ensure_ascii=False, default=str)
+        return type(self), self.container, config_signature
+
     def get_graph(self):
-        """获取编译后的图"""
+        """获取编译后的图
+
+        编译结果按智能体类与配置在进程内共享，同类同配置的实例只编译一次
+        """
         if self._graph is None:
-            self._graph = self.build_graph()
+            cache_key = self._graph_cache_key()
+            graph = AgentBase._graph_cache.get(cache_key)
+            if graph is None:
+                # 加锁后再检查一次，避免多个线程同时首次请求时重复编译
+                with AgentBase._graph_cache_lock:
+                    graph = AgentBase._graph_cache.get(cache_key)
+                    if graph is None:
+                        graph = self.build_graph()
+                        AgentBase._graph_cache[cache_key] = graph
+            self._graph = graph
         return self._graph
 
+    def invalidate_graph(self) -> None:
+        """清除编译后的图缓存（配置或代码热更新后调用），下次 get_graph 时重新编译"""
+        with AgentBase._graph_cache_lock:
+            AgentBase._graph_cache.pop(self._graph_cache_key(), None)
+        self._graph = None
+
+    async def warmup(self) -> None:
+        """启动预热：应用启动时调用，把一次性的初始化移出首个请求的关键路径
+
+        默认只编译图，子类可覆盖以预先初始化客户端等资源
+        """
+        self.get_graph()
+
+    async def shutdown(self) -> None:
+        """应用关闭时调用，子类可覆盖以释放连接等资源"""
+        pass
+
     @abstractmethod
     async def invoke(
             self,
@@ -140,10 +184,26 @@ class AgentBase(ABC):
                 file_path = prompt_file
         
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
+            mtime = os.stat(file_path).st_mtime
         except FileNotFoundError:
             raise FileNotFoundError(f"提示词文件不存在: {file_path}")
+
+        # 文件未修改时直接返回缓存内容，修改后自动重新读取
+        cached = AgentBase._prompt_cache.get(file_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with AgentBase._prompt_cache_lock:
+            cached = AgentBase._prompt_cache.get(file_path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                raise FileNotFoundError(f"提示词文件不存在: {file_path}")
+            AgentBase._prompt_cache[file_path] = (mtime, content)
+            return content
     
     # ============================================================
     # 新的依赖注入方式 - 通过服务容器访问组件
@@ -109,7 +109,7 @@ class CommonQAAgent(AgentBase):
         is_new_conversation = context and context.get('is_new_conversation', False)
         if is_new_conversation:
             history_messages = []
-            logger.debug(f"新对话 (thread_id={thread_id})，跳过历史消息查询")
+            logger.debug("新对话 (thread_id=%s)，跳过历史消息查询", thread_id)
         else:
             history_messages = await self.chat_history.get_messages(thread_id)
 
@@ -246,7 +246,7 @@ class CommonQAAgent(AgentBase):
         is_new_conversation = context and context.get('is_new_conversation', False)
         if is_new_conversation:
             history_messages = []
-            logger.debug(f"新对话 (thread_id={thread_id})，跳过历史消息查询（流式）")
+            logger.debug("新对话 (thread_id=%s)，跳过历史消息查询（流式）", thread_id)
         else:
             history_messages = await self.chat_history.get_messages(thread_id)
         
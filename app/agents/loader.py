@@ -5,41 +5,73 @@
 """
 
 import os
+import re
 import sys
 import yaml
 import importlib
 import logging
-import inspect
 from pathlib import Path
-from typing import Dict, Any, Type
+from typing import Dict, Any, Type, Optional, Tuple
 from .registry import AgentRegistry
 from .base import AgentBase
 
 logger = logging.getLogger(__name__)
 
+# 优先使用 libyaml 实现的 C 解析器，未编译 libyaml 时回退到纯 Python 实现
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+# 模型基类只导入一次，避免每次判断模型时重复查找 sys.modules
+try:
+    from app.core.services.db_base import Base as _Base
+except ImportError:
+    _Base = None
+
+# 配置中的环境变量占位符: ${ENV_VAR_NAME}，可嵌在字符串任意位置
+_ENV_VAR_PATTERN = re.compile(r'\$\{([^}]+)\}')
+
+
+def _substitute_env_var(match: re.Match) -> str:
+    env_var_name = match.group(1)
+    env_value = os.getenv(env_var_name)
+    if env_value is None:
+        logger.warning(f"环境变量 {env_var_name} 未设置，使用空字符串")
+        return ""
+    return env_value
+
 
 class AgentLoader:
     """智能体加载器
     
     负责自动发现、加载和注册智能体
     """
+
+    # agent.yaml 解析结果缓存: 文件路径 -> (修改时间, 配置)，重新加载时未修改的文件不再重复解析
+    _config_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
     
-    def __init__(self, container=None):
+    def __init__(self, container=None, reload: bool = False):
         """初始化加载器
         
         Args:
             container: 服务容器实例（用于依赖注入）
+            reload: 是否为重新加载（重新加载时才需要清理已缓存的智能体模块）
         """
         self.container = container
+        self.reload = reload
+        # 重新加载时按智能体包名分组的已缓存模块，只扫描一次 sys.modules
+        self._cached_agent_modules: Optional[Dict[str, list]] = None
     
     @classmethod
-    def load_all_agents(cls, container=None) -> None:
+    def load_all_agents(cls, container=None, reload: bool = False) -> None:
         """加载所有智能体
         
         Args:
             container: 服务容器实例（用于依赖注入）
+            reload: 是否为重新加载
         """
-        loader = cls(container)
+        loader = cls(container, reload=reload)
         loader._load_all()
     
     def _load_all(self) -> None:
@@ -69,8 +101,7 @@ class AgentLoader:
             config_file: 配置文件路径
         """
         # 读取配置文件
-        with open(config_file, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+        config = self._read_config(config_file)
         
         # 检查是否启用
         if not config.get('enabled', True):
@@ -101,16 +132,9 @@ class AgentLoader:
 
         # 动态导入智能体模块
         module_path = f"app.agents.{agent_dir.name}.agent"
-        module_prefix = f"app.agents.{agent_dir.name}."
         try:
-            # 清理已缓存的模块，确保加载最新代码
-            modules_to_clear = [
-                name for name in list(sys.modules.keys())
-                if name == module_path or name.startswith(module_prefix)
-            ]
-            package_path = f"app.agents.{agent_dir.name}"
-            if package_path in sys.modules:
-                modules_to_clear.append(package_path)
+            # 重新加载时清理已缓存的模块，确保加载最新代码；首次加载无需清理
+            modules_to_clear = self._get_cached_agent_modules(agent_dir.name) if self.reload else []
 
             if modules_to_clear:
                 logger.info(
@@ -149,6 +173,12 @@ class AgentLoader:
         agent_instance.author = config.get('author', 'Unknown')
         agent_instance.agent_dir = str(agent_dir)
         agent_instance.dependencies = config.get('dependencies', [])
+
+        # 预先编译图，避免首个请求承担编译开销；失败时保留懒加载，在首次调用时重试
+        try:
+            agent_instance.get_graph()
+        except Exception as e:
+            logger.warning(f"智能体 [{agent_name}] 预编译图失败，将在首次调用时重试: {e}")
         
         # 注册到注册中心
         AgentRegistry.register(agent_instance)
@@ -158,6 +188,46 @@ class AgentLoader:
         
         logger.info(f"✓ 智能体加载成功: {agent_name}")
     
+    def _read_config(self, config_file: Path) -> Dict[str, Any]:
+        """读取 agent.yaml，按文件修改时间缓存解析结果
+        
+        Args:
+            config_file: 配置文件路径
+            
+        Returns:
+            配置字典
+        """
+        cache_key = str(config_file)
+        mtime = config_file.stat().st_mtime
+        cached = AgentLoader._config_cache.get(cache_key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = yaml.load(f, Loader=_YamlLoader)
+        AgentLoader._config_cache[cache_key] = (mtime, config)
+        return config
+    
+    def _get_cached_agent_modules(self, agent_package: str) -> list:
+        """获取某个智能体包下已缓存的模块名
+
+        首次调用时扫描一次 sys.modules 并按智能体包名分组，后续直接查表
+        
+        Args:
+            agent_package: 智能体目录名
+            
+        Returns:
+            该智能体包及其子模块的模块名列表
+        """
+        if self._cached_agent_modules is None:
+            self._cached_agent_modules = {}
+            for name in list(sys.modules.keys()):
+                if not name.startswith("app.agents."):
+                    continue
+                package = name.split(".", 3)[2]
+                self._cached_agent_modules.setdefault(package, []).append(name)
+        return self._cached_agent_modules.get(agent_package, [])
+    
     def _discover_and_register_models(self, agent_dir: Path, agent_name: str) -> None:
         """自动发现并注册智能体的数据模型
         
@@ -190,14 +260,15 @@ class AgentLoader:
         # 扫描 SQLAlchemy 模型
         sqlalchemy_models = []
         
-        # 遍历模块中的所有成员
-        for name, obj in inspect.getmembers(models_module):
-            # 跳过私有成员和导入的模块
-            if name.startswith('_') or inspect.ismodule(obj):
+        # 直接遍历模块命名空间，无需 getmembers 的排序和属性访问
+        models_package = models_module.__name__
+        for name, obj in vars(models_module).items():
+            # 跳过私有成员，只处理类
+            if name.startswith('_') or not isinstance(obj, type):
                 continue
             
-            # 检查是否是类
-            if not inspect.isclass(obj):
+            # 只处理 models 包内定义的类（含子模块），跳过从外部导入的基类等
+            if not obj.__module__.startswith(models_package):
                 continue
             
             # 检查是否是 SQLAlchemy 模型
@@ -210,8 +281,7 @@ class AgentLoader:
             mysql_service = self.container.get('mysql')
             if mysql_service:
                 # 获取 Base.metadata
-                from app.core.services.db_base import Base
-                mysql_service.register_models(Base.metadata)
+                mysql_service.register_models(_Base.metadata)
                 logger.info(f"智能体 [{agent_name}] 注册了 {len(sqlalchemy_models)} 个 SQLAlchemy 模型")
     
     def _is_sqlalchemy_model(self, obj: Type) -> bool:
@@ -223,17 +293,14 @@ class AgentLoader:
         Returns:
             是否是 SQLAlchemy 模型
         """
-        try:
-            from app.core.services.db_base import Base
-            # 检查是否继承自 Base，且不是 Base 本身
-            return (
-                inspect.isclass(obj) and 
-                issubclass(obj, Base) and 
-                obj is not Base and
-                hasattr(obj, '__tablename__')  # 确保定义了表名
-            )
-        except ImportError:
-            return False
+        # 检查是否继承自 Base，且不是 Base 本身，并确保定义了表名
+        return (
+            _Base is not None and
+            isinstance(obj, type) and
+            issubclass(obj, _Base) and
+            obj is not _Base and
+            hasattr(obj, '__tablename__')
+        )
     
     def _resolve_config(self, config: Dict[str, Any]) -> Dict[str, Any]:
         """解析配置，支持环境变量替换
@@ -250,16 +317,9 @@ class AgentLoader:
             return {}
         
         for key, value in config.items():
-            if isinstance(value, str) and value.startswith('${') and value.endswith('}'):
-                # 环境变量格式: ${ENV_VAR_NAME}
-                env_var_name = value[2:-1]
-                env_value = os.getenv(env_var_name)
-                
-                if env_value is None:
-                    logger.warning(f"环境变量 {env_var_name} 未设置，使用空字符串")
-                    resolved_config[key] = ""
-                else:
-                    resolved_config[key] = env_value
+            if isinstance(value, str) and '${' in value:
+                # 环境变量格式: ${ENV_VAR_NAME}，支持 "prefix-${VAR}-suffix"
+                resolved_config[key] = _ENV_VAR_PATTERN.sub(_substitute_env_var, value)
             else:
                 resolved_config[key] = value
         
@@ -1,9 +1,13 @@
-import json
+import asyncio
 import logging
-from typing import Dict, Any, AsyncGenerator, Optional, List
+from typing import Dict, Any, AsyncGenerator, Optional, List, NamedTuple, Set
 
+import orjson
 from langgraph.graph import StateGraph
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from langchain_core.messages import HumanMessage, AIMessage
 
 from app.agents.base import AgentBase
 from app.core.chat_history import get_chat_history_manager
@@ -17,21 +21,105 @@ from .services.req_client import ReqSearchClient
 
 logger = logging.getLogger(__name__)
 
+# MySQL/Redis 的常见瞬时故障：只记录错误信息，不格式化完整堆栈
+_TRANSIENT_ERRORS = (OperationalError, RedisConnectionError, RedisTimeoutError, TimeoutError)
+
+# 会话历史写入语句只构造一次，每轮复用（编译结果由 SQLAlchemy 缓存）
+_INSERT_HISTORY = insert(SharedConversationHistory)
+
 
 def _build_references_card_from_retrieved(retrieved: List[RetrievedSlice]) -> str:
     """将 retrieved 构建为前端可渲染的参考来源卡片
 
     注意：这里严格按你的要求保留原有拼接逻辑与格式，只是从 state 中取数据。
     """
-    reference_content = []
-    for i, ref in enumerate(retrieved or [], 1):
-        title = ref.get("title", "")
-        content = ref.get("content", ref.get("para", ""))
-        reference_content.append(f"\n\n:::modal [{i}]{title}\n{content}\n\n:::\n\n")
+    # 每段自带原先 "\n".join 插入的分隔换行，末段的换行即卡片结尾前的换行，输出与原格式逐字节一致
+    parts = (
+        f"\n\n:::modal [{i}]{ref.get('title', '')}\n{ref.get('content', ref.get('para', ''))}\n\n:::\n\n\n"
+        for i, ref in enumerate(retrieved or [], 1)
+    )
+    return "\n\n:::card 参考来源\n" + "".join(parts) + ":::"
+
+
+def _build_and_cache_references(state: Dict[str, Any]) -> str:
+    """构建参考来源卡片并缓存在 state 上，同一轮内的输出与持久化复用同一字符串
+
+    以切片 id（缺失时用 title）序列作为缓存键，retrieved 变化时重新构建。
+    """
+    retrieved = state.get("retrieved") or []
+    if not retrieved:
+        return ""
+
+    key = tuple(r.get("id") or r.get("title") for r in retrieved)
+    cached = state.get("_references_card")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    card = _build_references_card_from_retrieved(retrieved)
+    state["_references_card"] = (key, card)
+    return card
+
+
+# 图事件缓冲队列容量：下游消费慢时图执行可以先行，队列满后再等待
+_STREAM_QUEUE_MAXSIZE = 64
+_STREAM_EOF = object()
+# 唯一向前端流式输出 token 的图节点
+_ANSWER_NODE = "compose_answer"
 
-    references_str = "\n".join(reference_content)
-    references_part = f"\n\n:::card 参考来源\n{references_str}\n:::"
-    return references_part
+
+async def _produce_graph_events(graph, initial_state: Dict[str, Any], queue: asyncio.Queue) -> None:
+    """生产者：迭代图事件，把 token 和最终状态放入队列
+
+    队列元素为 ("token", content) 或 ("end", output)；正常结束放入 _STREAM_EOF，异常原样转交给消费方。
+    """
+    try:
+        async for event in graph.astream_events(initial_state, version="v2"):
+            evt_type = event["event"]
+
+            # 热路径：直接取值，不逐层 get；只透传回答节点的 token，其它节点的模型调用不外泄
+            if evt_type == "on_chat_model_stream":
+                try:
+                    if event["metadata"]["langgraph_node"] != _ANSWER_NODE:
+                        continue
+                    content = event["data"]["chunk"].content
+                except (KeyError, TypeError, AttributeError):
+                    continue
+                if content:
+                    await queue.put(("token", content))
+                continue
+
+            if evt_type == "on_end":
+                evt_data = event.get("data") or {}
+                await queue.put(("end", evt_data.get("output") if isinstance(evt_data, dict) else None))
+    except Exception as e:
+        await queue.put(e)
+    else:
+        await queue.put(_STREAM_EOF)
+
+
+class _FinalFields(NamedTuple):
+    """图执行结束后各处（元数据输出、持久化）用到的字段，只从最终状态提取一次"""
+
+    rewritten_query: Any = None
+    can_answer: Any = None
+    answer_source: Any = None
+    fallback_reason: Any = None
+
+    @classmethod
+    def from_state(cls, state: Optional[Dict[str, Any]]) -> "_FinalFields":
+        if not isinstance(state, dict):
+            return cls()
+        return cls(
+            state.get("rewritten_query"),
+            state.get("can_answer"),
+            state.get("answer_source"),
+            state.get("fallback_reason"),
+        )
+
+
+def _dumps_metadata(meta: Dict[str, Any]) -> str:
+    """序列化 extra_metadata：orjson 输出紧凑 UTF-8（保留中文、无多余空白），比标准库 json 快"""
+    return orjson.dumps(meta).decode("utf-8")
 
 
 class RAGAgent(AgentBase):
@@ -51,7 +139,7 @@ class RAGAgent(AgentBase):
         self._graph: Optional[StateGraph] = None
         self._req_client: Optional[ReqSearchClient] = None
         self.chat_history = None  # 延迟初始化（异步）
-        self._system_prompt: Optional[str] = None
+        self._bg_tasks: Set[asyncio.Task] = set()  # 未完成的后台持久化任务
 
     async def _ensure_chat_history(self) -> None:
         """确保 chat_history 已初始化"""
@@ -59,13 +147,87 @@ class RAGAgent(AgentBase):
             self.chat_history = await get_chat_history_manager()
             logger.info("[agent] chat_history initialized")
 
-    @property
-    def system_prompt(self) -> str:
-        """懒加载系统提示词"""
-        if self._system_prompt is None:
-            self._system_prompt = self.load_prompt("system.md")
-            logger.info("[agent] system prompt loaded")
-        return self._system_prompt
+    async def _persist_turn(
+        self,
+        thread_id: str,
+        message: str,
+        context: Dict[str, Any],
+        log_tag: str,
+        answer: Optional[str] = None,
+        final: Optional[_FinalFields] = None,
+    ) -> None:
+        """在一个会话/事务内持久化本轮对话（共享表）
+
+        answer 为 None 表示图执行失败，只写入用户消息；失败只记录日志，不影响本轮回答。
+        """
+        try:
+            rows = [
+                {
+                    "thread_id": thread_id,
+                    "agent_name": self.name,
+                    "role": "user",
+                    "content": message,
+                    # 用户消息只保留有意义的 tag，无 tag 时不做序列化
+                    "extra_metadata": _dumps_metadata({"tag": context["tag"]}) if context.get("tag") else None,
+                }
+            ]
+            if answer is not None:
+                final = final or _FinalFields()
+                rows.append(
+                    {
+                        "thread_id": thread_id,
+                        "agent_name": self.name,
+                        "role": "assistant",
+                        "content": answer,
+                        "extra_metadata": _dumps_metadata(
+                            {
+                                "tag": context.get("tag"),
+                                "rewritten_query": final.rewritten_query,
+                                "can_answer": final.can_answer,
+                                "answer_source": final.answer_source,
+                                "fallback_reason": final.fallback_reason,
+                            }
+                        ),
+                    }
+                )
+
+            async with self.mysql.get_session() as session:
+                # Core executemany：不构造 ORM 实例、不走 unit-of-work
+                await session.execute(_INSERT_HISTORY, rows)
+                await session.commit()
+            logger.info("[%s] MySQL saved turn | messages=%s", log_tag, len(rows))
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("[%s] MySQL save turn failed | err=%s", log_tag, e)
+        except Exception as e:
+            logger.error("[%s] MySQL save turn failed | err=%s", log_tag, e, exc_info=True)
+
+    def _spawn_background(self, coro) -> None:
+        """以后台任务执行持久化，保留引用直到完成，关闭时统一等待"""
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+
+    async def _persist_stream_turn(
+        self,
+        thread_id: str,
+        message: str,
+        context: Dict[str, Any],
+        formatted_message: str,
+        final: _FinalFields,
+    ) -> None:
+        """流式回答结束后保存 Redis 历史并持久化本轮对话（后台任务）"""
+        try:
+            await self.chat_history.add_messages(
+                thread_id,
+                [HumanMessage(content=message), AIMessage(content=formatted_message)],
+            )
+            logger.info("[stream] redis history saved")
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("[stream] redis history save failed | err=%s", e)
+        except Exception as e:
+            logger.warning("[stream] redis history save failed | err=%s", e, exc_info=True)
+
+        await self._persist_turn(thread_id, message, context, "stream", formatted_message, final)
 
     @property
     def req_client(self) -> ReqSearchClient:
@@ -90,10 +252,27 @@ class RAGAgent(AgentBase):
             self._graph = build_rag_graph(
                 llm_service=self.llm,
                 req_client=self.req_client,
+                search_cache_ttl=self.config.get("RAG_SEARCH_CACHE_TTL"),
+                search_cache_maxsize=self.config.get("RAG_SEARCH_CACHE_MAXSIZE"),
             ).compile()
             logger.info("[agent] build_graph (compile) done")
         return self._graph
 
+    async def warmup(self) -> None:
+        """启动预热：提前初始化会话历史、检索客户端并编译图"""
+        await self._ensure_chat_history()
+        _ = self.req_client
+        self.get_graph()
+        logger.info("[agent] warmup done")
+
+    async def shutdown(self) -> None:
+        """等待后台持久化任务完成，并关闭检索客户端的连接池"""
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        if self._req_client is not None:
+            await self._req_client.aclose()
+            logger.info("[agent] req_client closed")
+
     async def invoke(self, message: str, thread_id: str, context: Dict[str, Any] = None) -> str:
         """非流式调用
 
@@ -110,33 +289,7 @@ class RAGAgent(AgentBase):
             bool(context.get("tag")),
         )
 
-        # ========== 持久化用户消息（共享表） ==========
-        try:
-            async with self.mysql.get_session() as session:
-                user_msg = SharedConversationHistory(
-                    thread_id=thread_id,
-                    agent_name=self.name,
-                    role="user",
-                    content=message,
-                    extra_metadata=json.dumps(context) if context else None,
-                )
-                session.add(user_msg)
-                await session.commit()
-            logger.info("[invoke] MySQL saved user message")
-        except Exception as e:
-            logger.error("[invoke] MySQL save user message failed | err=%s", e, exc_info=True)
-
-        # ========== 历史消息（与 common_qa 一致） ==========
-        if is_new_conversation:
-            history_messages = []
-            logger.info("[invoke] new conversation: skip history loading")
-        else:
-            history_messages = await self.chat_history.get_messages(thread_id)
-            logger.info("[invoke] history loaded | count=%s", len(history_messages))
-
-        if not history_messages:
-            history_messages = [SystemMessage(content=self.system_prompt)]
-
+        # 图不依赖历史消息，这里不从 Redis 拉取历史；本轮结束后仍会写入 Redis
         # ========== 图调用 ==========
         initial_state: RAGState = {
             "agent_config": self.config,
@@ -148,61 +301,46 @@ class RAGAgent(AgentBase):
             "retrieved": [],
             "references": [],
             "metadata": {"thread_id": thread_id},
-            "history_messages": history_messages,
+            "enable_streaming": False,
         }
 
         graph = self.get_graph()
-        result_state = await graph.ainvoke(initial_state)
+        try:
+            result_state = await graph.ainvoke(initial_state)
+        except Exception:
+            # 图执行失败时只持久化用户消息
+            self._spawn_background(self._persist_turn(thread_id, message, context, "invoke"))
+            raise
 
         answer = (result_state.get("answer") or "").strip()
         retrieved = result_state.get("retrieved") or []
+        final = _FinalFields.from_state(result_state)
 
         # 拼接参考来源（保持你的原始格式）
-        if retrieved:
-            references_part = _build_references_card_from_retrieved(retrieved)
-            formatted_message = f"\n{answer}{references_part}"
-        else:
-            formatted_message = f"\n{answer}"
+        references_part = _build_and_cache_references(result_state)
+        formatted_message = f"\n{answer}{references_part}"
 
         logger.info(
             "[invoke] graph done | answer_len=%s | retrieved_count=%s | answer_source=%s",
             len(answer),
             len(retrieved),
-            result_state.get("answer_source"),
+            final.answer_source,
         )
 
         # ========== 保存 Redis 历史（与 common_qa 一致） ==========
         try:
-            await self.chat_history.add_message(thread_id, HumanMessage(content=message))
-            await self.chat_history.add_message(thread_id, AIMessage(content=formatted_message))
+            await self.chat_history.add_messages(
+                thread_id,
+                [HumanMessage(content=message), AIMessage(content=formatted_message)],
+            )
             logger.info("[invoke] redis history saved")
+        except _TRANSIENT_ERRORS as e:
+            logger.warning("[invoke] redis history save failed | err=%s", e)
         except Exception as e:
             logger.warning("[invoke] redis history save failed | err=%s", e, exc_info=True)
 
-        # ========== 持久化 AI 回复（共享表） ==========
-        try:
-            async with self.mysql.get_session() as session:
-                ai_msg = SharedConversationHistory(
-                    thread_id=thread_id,
-                    agent_name=self.name,
-                    role="assistant",
-                    content=formatted_message,
-                    extra_metadata=json.dumps(
-                        {
-                            "tag": context.get("tag"),
-                            "rewritten_query": result_state.get("rewritten_query"),
-                            "can_answer": result_state.get("can_answer"),
-                            "answer_source": result_state.get("answer_source"),
-                            "fallback_reason": result_state.get("fallback_reason"),
-                        },
-                        ensure_ascii=False,
-                    ),
-                )
-                session.add(ai_msg)
-                await session.commit()
-            logger.info("[invoke] MySQL saved assistant message")
-        except Exception as e:
-            logger.error("[invoke] MySQL save assistant message failed | err=%s", e, exc_info=True)
+        # ========== 持久化本轮对话（共享表，用户消息与 AI 回复同一事务；后台执行，不阻塞返回） ==========
+        self._spawn_background(self._persist_turn(thread_id, message, context, "invoke", formatted_message, final))
 
         return formatted_message
 
@@ -210,7 +348,7 @@ class RAGAgent(AgentBase):
         """流式调用
 
         关键修复点：
-        - rewrite_query 节点是非流式（ainvoke），因此不会产生 on_chat_model_stream → 不会把“改写查询”流到前端。
+        - 查询改写（speculative_retrieve 节点内）是非流式（ainvoke），因此不会产生 on_chat_model_stream → 不会把“改写查询”流到前端。
         - 只有 compose_answer 节点使用 streaming → 前端只看到答案 token。
         - 当图执行结束（on_end）后，**立刻输出参考来源卡片**（type=message）。
         """
@@ -224,33 +362,7 @@ class RAGAgent(AgentBase):
             is_new_conversation,
         )
 
-        # ========== 持久化用户消息（共享表） ==========
-        try:
-            async with self.mysql.get_session() as session:
-                user_msg = SharedConversationHistory(
-                    thread_id=thread_id,
-                    agent_name=self.name,
-                    role="user",
-                    content=message,
-                    extra_metadata=json.dumps(context) if context else None,
-                )
-                session.add(user_msg)
-                await session.commit()
-            logger.info("[stream] MySQL saved user message")
-        except Exception as e:
-            logger.error("[stream] MySQL save user message failed | err=%s", e, exc_info=True)
-
-        # ========== 历史消息 ==========
-        if is_new_conversation:
-            history_messages = []
-            logger.info("[stream] new conversation: skip history loading")
-        else:
-            history_messages = await self.chat_history.get_messages(thread_id)
-            logger.info("[stream] history loaded | count=%s", len(history_messages))
-
-        if not history_messages:
-            history_messages = [SystemMessage(content=self.system_prompt)]
-
+        # 图不依赖历史消息，这里不从 Redis 拉取历史；本轮结束后仍会写入 Redis
         initial_state: RAGState = {
             "agent_config": self.config,
             "domain_context": None,
@@ -261,105 +373,112 @@ class RAGAgent(AgentBase):
             "retrieved": [],
             "references": [],
             "metadata": {"thread_id": thread_id},
-            "history_messages": history_messages,
+            "enable_streaming": True,
         }
 
         graph = self.get_graph()
-        full_answer = ""
+        # token 先收集到列表，结束时一次拼接，避免逐 token 字符串累加
+        answer_parts: List[str] = []
+        append_answer = answer_parts.append
         final_state: Optional[Dict[str, Any]] = None
+        turn_saved = False
 
         try:
-            async for event in graph.astream_events(initial_state, version="v2"):
-                evt_type = event.get("event")
-                evt_data = event.get("data") or {}
-
-                # 详细日志：用于排查事件流结构与最终 output 是否包含 retrieved/references
-                # try:
-                #     if evt_type in ("on_chat_model_stream", "on_end"):
-                #         logger.debug(
-                #             "[stream] event=%s | data_keys=%s",
-                #             evt_type,
-                #             list(evt_data.keys()) if isinstance(evt_data, dict) else None,
-                #         )
-                # except Exception:
-                #     pass
-
-                # ========== 透传模型 token ==========
-                if evt_type == "on_chat_model_stream":
-                    chunk = evt_data.get("chunk")
-                    if chunk is None:
+            # 相邻的小 token 合并后再下发：累计达到字节数或距上次下发超过间隔时下发，流结束时下发剩余部分
+            coalesce_bytes = int(self.config.get("STREAM_COALESCE_BYTES", 64))
+            coalesce_interval = float(self.config.get("STREAM_COALESCE_INTERVAL", 0.02))
+            loop = asyncio.get_running_loop()
+            pending: List[str] = []
+            pending_len = 0
+            last_flush = loop.time()
+
+            queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_MAXSIZE)
+            producer = asyncio.create_task(_produce_graph_events(graph, initial_state, queue))
+            try:
+                while True:
+                    if pending:
+                        # 有未下发的 token 时最多等到本轮间隔结束，超时即下发，避免模型停顿时尾部 token 滞留
+                        timeout = last_flush + coalesce_interval - loop.time()
+                        try:
+                            if timeout > 0:
+                                item = await asyncio.wait_for(queue.get(), timeout)
+                            else:
+                                item = queue.get_nowait()
+                        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                            yield {"type": "message", "data": "".join(pending)}
+                            pending.clear()
+                            pending_len = 0
+                            last_flush = loop.time()
+                            continue
+                    else:
+                        item = await queue.get()
+
+                    if item is _STREAM_EOF:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    kind, value = item
+
+                    # ========== 透传模型 token ==========
+                    if kind == "token":
+                        append_answer(value)
+                        pending.append(value)
+                        pending_len += len(value)
+                        now = loop.time()
+                        if pending_len >= coalesce_bytes or now - last_flush >= coalesce_interval:
+                            yield {"type": "message", "data": "".join(pending)}
+                            pending.clear()
+                            pending_len = 0
+                            last_flush = now
                         continue
-                    content = getattr(chunk, "content", None)
-                    if content:
-                        full_answer += content
-                        yield {"type": "message", "data": content}
-
-                # ========== 获取最终状态 ==========
-                if evt_type == "on_end":
-                    final_state = evt_data.get("output") if isinstance(evt_data, dict) else None
+
+                    # ========== 获取最终状态 ==========
+                    final_state = value
                     if isinstance(final_state, dict):
-                        logger.info(
-                            "[stream] on_end | keys=%s | retrieved_count=%s",
-                            list(final_state.keys()),
-                            len(final_state.get("retrieved") or []),
-                        )
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info(
+                                "[stream] on_end | keys=%s | retrieved_count=%s",
+                                list(final_state.keys()),
+                                len(final_state.get("retrieved") or []),
+                            )
                     else:
                         logger.warning("[stream] on_end without dict output | output_type=%s", type(final_state))
+            finally:
+                producer.cancel()
+
+            if pending:
+                yield {"type": "message", "data": "".join(pending)}
+
+            full_answer = "".join(answer_parts)
+            final = _FinalFields.from_state(final_state)
 
             # ========== 回答结束后，追加参考来源 ==========
-            retrieved = (final_state or {}).get("retrieved") or []
-            references_part = ""
-            if retrieved:
-                references_part = _build_references_card_from_retrieved(retrieved)
+            references_part = _build_and_cache_references(final_state) if isinstance(final_state, dict) else ""
+            if references_part:
                 # 注意：必须保持 type 只有 message（按你的约束）
                 yield {"type": "message", "data": references_part}
 
-            # ========== 保存历史与持久化 ==========
-            formatted_message = f"\n{full_answer}{references_part}" if references_part else f"\n{full_answer}"
-
-            try:
-                await self.chat_history.add_message(thread_id, HumanMessage(content=message))
-                await self.chat_history.add_message(thread_id, AIMessage(content=formatted_message))
-                logger.info("[stream] redis history saved")
-            except Exception as e:
-                logger.warning("[stream] redis history save failed | err=%s", e, exc_info=True)
-
-            try:
-                async with self.mysql.get_session() as session:
-                    ai_msg = SharedConversationHistory(
-                        thread_id=thread_id,
-                        agent_name=self.name,
-                        role="assistant",
-                        content=formatted_message,
-                        extra_metadata=json.dumps(
-                            {
-                                "tag": context.get("tag"),
-                                "rewritten_query": (final_state or {}).get("rewritten_query"),
-                                "can_answer": (final_state or {}).get("can_answer"),
-                                "answer_source": (final_state or {}).get("answer_source"),
-                                "fallback_reason": (final_state or {}).get("fallback_reason"),
-                            },
-                            ensure_ascii=False,
-                        ),
-                    )
-                    session.add(ai_msg)
-                    await session.commit()
-                logger.info("[stream] MySQL saved assistant message")
-            except Exception as e:
-                logger.error("[stream] MySQL save assistant message failed | err=%s", e, exc_info=True)
+            # ========== 保存历史与持久化（后台执行，不阻塞元数据输出） ==========
+            formatted_message = f"\n{full_answer}{references_part}"
+            self._spawn_background(self._persist_stream_turn(thread_id, message, context, formatted_message, final))
+            turn_saved = True
 
             # ========== 输出元数据 ==========
             yield {
                 "type": "metadata",
                 "data": {
                     "thread_id": thread_id,
-                    "can_answer": (final_state or {}).get("can_answer"),
-                    "answer_source": (final_state or {}).get("answer_source"),
-                    "fallback_reason": (final_state or {}).get("fallback_reason"),
+                    "can_answer": final.can_answer,
+                    "answer_source": final.answer_source,
+                    "fallback_reason": final.fallback_reason,
                 },
             }
 
         except Exception as e:
             logger.error("[stream] LangGraph stream failed | err=%s", e, exc_info=True)
             yield {"type": "error", "data": str(e)}
+        finally:
+            # 流中途失败或客户端断开时，只持久化用户消息
+            if not turn_saved:
+                self._spawn_background(self._persist_turn(thread_id, message, context, "stream"))
 
@@ -7,30 +7,29 @@ from . import nodes
 logger = logging.getLogger(__name__)
 
 
-def build_rag_graph(llm_service, req_client) -> StateGraph:
+def build_rag_graph(llm_service, req_client, search_cache_ttl=None, search_cache_maxsize=None) -> StateGraph:
     """构建 RAG 工作流图
 
     设计目标（对齐 common_qa 的简洁风格）：
-    - 节点清晰：parse_input → rewrite_query → req_search → compose_answer → END
+    - 节点清晰：parse_input → speculative_retrieve（改写与检索并发） → compose_answer → END
     - 依赖注入：通过 nodes.set_* 注入 llm_service/req_client
     - 方便 debug：节点内提供详细日志
     """
     logger.info("[graph] building rag graph...")
     nodes.set_llm_service(llm_service)
     nodes.set_req_client(req_client)
+    nodes.set_search_cache(ttl_seconds=search_cache_ttl, maxsize=search_cache_maxsize)
 
     workflow = StateGraph(RAGState)
 
     workflow.add_node("parse_input", nodes.parse_input_node)
-    workflow.add_node("rewrite_query", nodes.rewrite_query_node)
-    workflow.add_node("req_search", nodes.req_search_node)
+    workflow.add_node("speculative_retrieve", nodes.speculative_retrieve_node)
     workflow.add_node("compose_answer", nodes.compose_answer_node)
 
     workflow.set_entry_point("parse_input")
 
-    workflow.add_edge("parse_input", "rewrite_query")
-    workflow.add_edge("rewrite_query", "req_search")
-    workflow.add_edge("req_search", "compose_answer")
+    workflow.add_edge("parse_input", "speculative_retrieve")
+    workflow.add_edge("speculative_retrieve", "compose_answer")
     workflow.add_edge("compose_answer", END)
 
     logger.info("[graph] rag graph ready")
@@ -1,6 +1,10 @@
+import asyncio
 import logging
 import os
-from typing import Dict, Any, List, Optional, Tuple
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple
 
 from langchain_core.messages import SystemMessage, HumanMessage
 
@@ -14,9 +18,25 @@ logger = logging.getLogger(__name__)
 _llm_service = None
 _req_client = None
 
-# Prompt 懒加载缓存（避免频繁读文件）
-_rewrite_prompt: Optional[str] = None
-_answer_prompt: Optional[str] = None
+# 输入格式 "searchTagFilter:xxx, query:yyy"，一次匹配同时取出 tag 与 query（缺少 query 部分时 query 为空）
+_TAG_QUERY_PATTERN = re.compile(r"searchTagFilter:(?P<tag>.*?)(?:, query:(?P<query>.*))?\Z", re.DOTALL)
+
+# 短查询（去空白后字符数低于该值）改写收益很低，跳过改写直接使用原始 query，省去一次 LLM 调用
+REWRITE_MIN_QUERY_LEN = 8
+
+# 推测检索：改写前后 query 的字符二元组 Jaccard 相似度不低于该阈值时，复用原始 query 的检索结果
+SPECULATIVE_SIMILARITY = 0.8
+
+# 检索结果进程内缓存：(query, tag) -> (过期时间, retrieved)，LRU 淘汰 + TTL 过期
+SEARCH_CACHE_MAXSIZE = 1024
+SEARCH_CACHE_TTL_SECONDS = 60.0
+_search_cache: "OrderedDict[Tuple[str, Optional[str]], Tuple[float, List[RetrievedSlice]]]" = OrderedDict()
+# 缓存键归一化：合并空白、去掉首尾标点并转小写；中间的符号（如 C++、1.2、a_b）保留，避免不同 query 共用缓存
+_CACHE_KEY_STRIP_CHARS = "？?。.!！，,；;：: "
+# 进行中的检索（singleflight）：相同 (query, tag) 的并发请求共享同一次远程调用
+_search_inflight: Dict[Tuple[str, Optional[str]], "asyncio.Task[List[RetrievedSlice]]"] = {}
+
+_PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
 
 
 def set_llm_service(llm_service) -> None:
@@ -33,14 +53,41 @@ def set_req_client(req_client) -> None:
     logger.info("[nodes] req_client injected: %s", type(req_client).__name__)
 
 
+def set_search_cache(ttl_seconds: Optional[float] = None, maxsize: Optional[int] = None) -> None:
+    """配置检索结果缓存（由 graph 构建阶段调用，未指定的参数保持默认值）"""
+    global SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_MAXSIZE
+    if ttl_seconds is not None:
+        SEARCH_CACHE_TTL_SECONDS = float(ttl_seconds)
+    if maxsize is not None:
+        SEARCH_CACHE_MAXSIZE = int(maxsize)
+    logger.info(
+        "[nodes] search cache configured | ttl=%s | maxsize=%s",
+        SEARCH_CACHE_TTL_SECONDS,
+        SEARCH_CACHE_MAXSIZE,
+    )
+
+
 def _load_prompt(file_name: str) -> str:
     """从当前智能体 prompts 目录读取提示词文件"""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    prompt_path = os.path.join(base_dir, "prompts", file_name)
-    with open(prompt_path, "r", encoding="utf-8") as f:
+    with open(os.path.join(_PROMPTS_DIR, file_name), "r", encoding="utf-8") as f:
         return f.read()
 
 
+def _preload_system_message(file_name: str) -> Optional[SystemMessage]:
+    """模块导入时预加载提示词并构造 SystemMessage，读取失败只记录日志，节点首次使用时再重试"""
+    try:
+        return SystemMessage(content=_load_prompt(file_name))
+    except OSError as e:
+        logger.error("[nodes] preload prompt failed | file=%s | err=%s", file_name, e)
+        return None
+
+
+# Prompt 在导入时读入内存并构造为 SystemMessage，各请求复用同一实例（只读），
+# 异步节点内不再访问文件系统，也不再逐请求实例化消息对象
+_rewrite_system_message: Optional[SystemMessage] = _preload_system_message("rewrite_query.md")
+_answer_system_message: Optional[SystemMessage] = _preload_system_message("answer_with_refs.md")
+
+
 def _build_references_from_retrieved(retrieved: List[RetrievedSlice]) -> List[Dict[str, Any]]:
     """根据 retrieved 构造 references（用于后续展示/去重/扩展）
 
@@ -73,10 +120,10 @@ async def parse_input_node(state: RAGState) -> RAGState:
     tag: Optional[str] = None
     query_text: str = raw_text
 
-    if raw_text.startswith("searchTagFilter:"):
-        parts = raw_text.split(", query:", 1)
-        tag = parts[0].replace("searchTagFilter:", "").strip() if parts else None
-        query_text = parts[1].strip() if len(parts) > 1 else ""
+    match = _TAG_QUERY_PATTERN.match(raw_text)
+    if match:
+        tag = match.group("tag").strip()
+        query_text = (match.group("query") or "").strip()
 
     domain_context = state.get("domain_context") or {}
     domain_context.update({"last_query": query_text})
@@ -86,87 +133,184 @@ async def parse_input_node(state: RAGState) -> RAGState:
         tag,
         query_text,
     )
-    return {**state, "parsed_query": query_text, "tag": tag, "domain_context": domain_context}
+    return {"parsed_query": query_text, "tag": tag, "domain_context": domain_context}
 
 
-async def rewrite_query_node(state: RAGState) -> RAGState:
-    """查询改写（非流式）
-
-    关键点（修复你现在的“改写内容被前端输出”的问题）：
-    - 本节点**只使用 ainvoke**（非流式），因此不会产生 on_chat_model_stream 事件。
-    - 改写结果写入 state.rewritten_query，供后续检索使用。
-    """
-    query_text = state.get("parsed_query") or state.get("raw_input") or ""
-    logger.info("[rewrite_query_node] start | query_len=%s", len(query_text))
+async def _rewrite_query(query_text: str) -> str:
+    """调用 LLM 改写查询（非流式），短查询、失败或未注入时使用原始 query"""
+    if len("".join(query_text.split())) < REWRITE_MIN_QUERY_LEN:
+        logger.info("[rewrite_query] short query, skip rewrite | query=%s", query_text)
+        return query_text
 
     if not _llm_service:
-        logger.error("[rewrite_query_node] llm_service not injected, fallback to original query")
-        return {**state, "rewritten_query": query_text}
+        logger.error("[rewrite_query] llm_service not injected, fallback to original query")
+        return query_text
 
-    global _rewrite_prompt
-    if _rewrite_prompt is None:
-        _rewrite_prompt = _load_prompt("rewrite_query.md")
-        logger.info("[rewrite_query_node] rewrite prompt loaded")
+    global _rewrite_system_message
+    if _rewrite_system_message is None:
+        # 仅在导入时预加载失败的情况下才会走到这里
+        _rewrite_system_message = SystemMessage(content=_load_prompt("rewrite_query.md"))
 
     llm = _llm_service.get_model(temperature=0.1)
     messages = [
-        SystemMessage(content=_rewrite_prompt),
+        _rewrite_system_message,
         HumanMessage(content=f"原始问题：{query_text}"),
     ]
 
-    rewritten_query = query_text
     try:
         resp = await llm.ainvoke(messages)
         content = _llm_service.clean_response(resp.content)
         rewritten_query = (content or "").strip() or query_text
         logger.info(
-            "[rewrite_query_node] rewrite ok | original=%s | rewritten=%s",
+            "[rewrite_query] rewrite ok | original=%s | rewritten=%s",
             query_text,
             rewritten_query,
         )
+        return rewritten_query
     except Exception as e:
-        logger.warning("[rewrite_query_node] rewrite failed, fallback | err=%s", e, exc_info=True)
-        rewritten_query = query_text
+        logger.warning("[rewrite_query] rewrite failed, fallback | err=%s", e, exc_info=True)
+        return query_text
+
+
+async def _search(query_text: str, tag: Optional[str]) -> RAGState:
+    """调用检索接口，返回 retrieved/references（失败时带 error）"""
+    logger.info(
+        "[req_search] start | query=%s | tag=%s",
+        query_text,
+        tag,
+    )
+
+    if not _req_client:
+        logger.error("[req_search] req_client not injected, skip search")
+        return {"retrieved": [], "references": [], "error": "req_client_not_injected"}
+
+    cache_key = (_normalize_cache_query(query_text), tag)
+    retrieved = _search_cache_get(cache_key)
+    if retrieved is not None:
+        logger.info("[req_search] cache hit | retrieved_count=%s", len(retrieved))
+    else:
+        task = _search_inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(_fetch_and_cache(cache_key, query_text, tag))
+            _search_inflight[cache_key] = task
+            task.add_done_callback(lambda _t: _search_inflight.pop(cache_key, None))
+        else:
+            logger.info("[req_search] join inflight search | query=%s | tag=%s", query_text, tag)
+        try:
+            # shield：某个等待方被取消时不影响共享同一检索的其他请求
+            retrieved = await asyncio.shield(task)
+            logger.info("[req_search] search ok | retrieved_count=%s", len(retrieved))
+            logger.debug("[req_search] retrieved_preview=%s", (retrieved[:2] if retrieved else []))
+        except Exception as e:
+            # 失败结果不缓存，下一次请求重新检索
+            logger.error("[req_search] search failed | err=%s", e, exc_info=True)
+            return {"retrieved": [], "references": [], "error": f"search_failed:{e}"}
+
+    references = _build_references_from_retrieved(retrieved)
+    logger.info("[req_search] references built | references_count=%s", len(references))
+
+    return {"retrieved": retrieved, "references": references}
+
+
+def _normalize_cache_query(query_text: str) -> str:
+    """生成检索缓存用的归一化 query（不影响实际发给检索接口的 query）"""
+    return " ".join(query_text.split()).strip(_CACHE_KEY_STRIP_CHARS).lower() or query_text
+
+
+async def _fetch_and_cache(
+    key: Tuple[str, Optional[str]], query_text: str, tag: Optional[str]
+) -> List[RetrievedSlice]:
+    """执行一次远程检索，成功后写入缓存（失败直接抛出，不缓存）"""
+    retrieved = await _req_client.search(query_text, tag)
+    _search_cache_put(key, retrieved)
+    return retrieved
 
-    domain_context = state.get("domain_context") or {}
-    domain_context.update({"last_query": rewritten_query})
 
-    return {**state, "rewritten_query": rewritten_query, "domain_context": domain_context}
+def _search_cache_get(key: Tuple[str, Optional[str]]) -> Optional[List[RetrievedSlice]]:
+    """读取未过期的检索缓存，命中时移到队尾（最近使用）"""
+    entry = _search_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _search_cache[key]
+        return None
+    _search_cache.move_to_end(key)
+    return entry[1]
 
 
-async def req_search_node(state: RAGState) -> RAGState:
-    """调用检索接口，将结果写入 retrieved，并构造 references
+def _search_cache_put(key: Tuple[str, Optional[str]], retrieved: List[RetrievedSlice]) -> None:
+    """写入检索缓存，超出容量时淘汰最久未使用的条目"""
+    _search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL_SECONDS, retrieved)
+    _search_cache.move_to_end(key)
+    if len(_search_cache) > SEARCH_CACHE_MAXSIZE:
+        _search_cache.popitem(last=False)
 
-    需求对齐：
-    - **retrieved**：接口返回内容存进 retrieved（原样/最小加工）。
-    - **references**：把“拼接/整理后的结果”存进 references（结构化整理）。
+
+def _bigrams(text: str) -> Set[str]:
+    """字符二元组集合（中文无空格分词，按字符切分更稳定）"""
+    text = "".join(text.split()).lower()
+    if len(text) < 2:
+        return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _queries_similar(original: str, rewritten: str) -> bool:
+    """判断改写前后的 query 是否基本一致（一致则可直接复用推测检索结果）"""
+    if original.strip().lower() == rewritten.strip().lower():
+        return True
+    a, b = _bigrams(original), _bigrams(rewritten)
+    return len(a & b) / len(a | b) >= SPECULATIVE_SIMILARITY
+
+
+async def speculative_retrieve_node(state: RAGState) -> RAGState:
+    """查询改写与检索并发执行（推测检索）
+
+    - 用原始 query 推测检索，同时调用 LLM 改写，耗时由 LLM+检索 变为 max(LLM, 检索)。
+    - 改写结果与原始 query 基本一致：直接复用推测检索结果。
+    - 改写明显不同：再用改写后的 query 检索一次并替换结果（与串行流程结果一致）。
     """
-    query_text = state.get("rewritten_query") or state.get("parsed_query") or state.get("raw_input") or ""
+    query_text = state.get("parsed_query") or state.get("raw_input") or ""
     tag = state.get("tag")
+    logger.info("[speculative_retrieve_node] start | query_len=%s", len(query_text))
 
-    logger.info(
-        "[req_search_node] start | query=%s | tag=%s",
-        query_text,
-        tag,
+    rewritten_query, search_result = await asyncio.gather(
+        _rewrite_query(query_text),
+        _search(query_text, tag),
     )
 
-    if not _req_client:
-        logger.error("[req_search_node] req_client not injected, skip search")
-        return {**state, "retrieved": [], "references": [], "error": "req_client_not_injected"}
+    if _queries_similar(query_text, rewritten_query):
+        logger.info("[speculative_retrieve_node] speculative hit, reuse search result")
+    else:
+        logger.info("[speculative_retrieve_node] rewrite differs, re-search with rewritten query")
+        search_result = await _search(rewritten_query, tag)
 
-    retrieved: List[RetrievedSlice] = []
-    try:
-        retrieved = await _req_client.search(query_text, tag)
-        logger.info("[req_search_node] search ok | retrieved_count=%s", len(retrieved))
-        logger.debug("[req_search_node] retrieved_preview=%s", (retrieved[:2] if retrieved else []))
-    except Exception as e:
-        logger.error("[req_search_node] search failed | err=%s", e, exc_info=True)
-        return {**state, "retrieved": [], "references": [], "error": f"search_failed:{e}"}
+    domain_context = state.get("domain_context") or {}
+    domain_context.update({"last_query": rewritten_query})
+
+    return {"rewritten_query": rewritten_query, "domain_context": domain_context, **search_result}
 
-    references = _build_references_from_retrieved(retrieved)
-    logger.info("[req_search_node] references built | references_count=%s", len(references))
 
-    return {**state, "retrieved": retrieved, "references": references}
+async def _generate_answer(llm, messages: List[Any], streaming: bool, branch: str) -> str:
+    """调用模型生成回答
+
+    - streaming=True：流式调用，确保 agent.stream 能从 graph.astream_events 捕获 on_chat_model_stream；
+      失败时回退到 ainvoke。
+    - streaming=False（invoke 入口，不向前端流式输出）：直接 ainvoke，省去逐 chunk 的开销。
+    """
+    if not streaming:
+        resp = await llm.ainvoke(messages)
+        return _llm_service.clean_response(resp.content)
+
+    parts: List[str] = []
+    try:
+        async for chunk in llm.astream(messages):
+            if hasattr(chunk, "content") and chunk.content:
+                parts.append(chunk.content)
+        return _llm_service.clean_response("".join(parts))
+    except Exception as e:
+        logger.warning("[compose_answer_node] %s stream failed, try ainvoke | err=%s", branch, e, exc_info=True)
+        resp = await llm.ainvoke(messages)
+        return _llm_service.clean_response(resp.content)
 
 
 async def compose_answer_node(state: RAGState) -> RAGState:
@@ -182,7 +326,7 @@ async def compose_answer_node(state: RAGState) -> RAGState:
     """
     if not _llm_service:
         logger.error("[compose_answer_node] llm_service not injected")
-        return {**state, "answer": "系统错误：LLM 服务不可用", "answer_source": "llm_fallback", "can_answer": False}
+        return {"answer": "系统错误：LLM 服务不可用", "answer_source": "llm_fallback", "can_answer": False}
 
     raw_q = state.get("raw_input") or ""
     rewritten = state.get("rewritten_query") or state.get("parsed_query") or raw_q
@@ -209,20 +353,9 @@ async def compose_answer_node(state: RAGState) -> RAGState:
             )
         ]
 
-        # 使用流式调用，确保 agent.stream 能从 graph.astream_events 捕获 on_chat_model_stream
-        resp_content = ""
-        try:
-            async for chunk in llm.astream(messages):
-                if hasattr(chunk, "content") and chunk.content:
-                    resp_content += chunk.content
-            answer = _llm_service.clean_response(resp_content)
-        except Exception as e:
-            logger.warning("[compose_answer_node] fallback stream failed, try ainvoke | err=%s", e, exc_info=True)
-            resp = await llm.ainvoke(messages)
-            answer = _llm_service.clean_response(resp.content)
+        answer = await _generate_answer(llm, messages, state.get("enable_streaming", True), "fallback")
 
         return {
-            **state,
             "answer": answer,
             "answer_source": "llm_fallback",
             "can_answer": True,
@@ -230,22 +363,20 @@ async def compose_answer_node(state: RAGState) -> RAGState:
         }
 
     # ========== RAG：有检索结果 ==========
-    global _answer_prompt
-    if _answer_prompt is None:
-        _answer_prompt = _load_prompt("answer_with_refs.md")
-        logger.info("[compose_answer_node] answer prompt loaded")
+    global _answer_system_message
+    if _answer_system_message is None:
+        # 仅在导入时预加载失败的情况下才会走到这里
+        _answer_system_message = SystemMessage(content=_load_prompt("answer_with_refs.md"))
 
     # 将检索切片以更友好的格式拼入 prompt（便于模型专注使用）
-    slices_lines: List[str] = []
-    for idx, item in enumerate(retrieved, start=1):
-        title = item.get("title", "")
-        content = item.get("content", item.get("para", ""))
-        slices_lines.append(f"[{idx}] {title}\n{content}")
-    slices_text = "\n\n".join(slices_lines)
+    slices_text = "\n\n".join(
+        f"[{idx}] {item.get('title', '')}\n{item.get('content', item.get('para', ''))}"
+        for idx, item in enumerate(retrieved, start=1)
+    )
 
     llm = _llm_service.get_model(temperature=0.2)
     messages = [
-        SystemMessage(content=_answer_prompt),
+        _answer_system_message,
         HumanMessage(
             content=(
                 f"用户原始问题：{raw_q}\n"
@@ -255,19 +386,9 @@ async def compose_answer_node(state: RAGState) -> RAGState:
         ),
     ]
 
-    resp_content = ""
-    try:
-        async for chunk in llm.astream(messages):
-            if hasattr(chunk, "content") and chunk.content:
-                resp_content += chunk.content
-        answer = _llm_service.clean_response(resp_content)
-    except Exception as e:
-        logger.warning("[compose_answer_node] rag stream failed, try ainvoke | err=%s", e, exc_info=True)
-        resp = await llm.ainvoke(messages)
-        answer = _llm_service.clean_response(resp.content)
+    answer = await _generate_answer(llm, messages, state.get("enable_streaming", True), "rag")
 
     return {
-        **state,
         "answer": answer,
         "answer_source": "kb",
         "can_answer": True,
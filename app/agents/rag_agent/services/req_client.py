@@ -3,16 +3,15 @@
 重要说明：
 - 当前实现沿用既有接口协议/拼接方式，避免影响线上行为与检索召回。
 
-TODO（可选优化）：
-- 这里当前用的是 `requests` 同步请求，包了一层 async 方法，会阻塞事件循环；
-  如果后续要提升并发/流式体验，建议改为 `httpx.AsyncClient`。
+- 使用进程内长连接的 `httpx.AsyncClient`，不阻塞事件循环，并复用 TCP 连接。
 """
 
 import json
 import logging
 from typing import List, Dict, Any, Optional
 
-import requests
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +23,35 @@ class ReqSearchClient:
         self.base_url = base_url
         self.user_id = user_id
         self.timeout_seconds = timeout_seconds
+        self._http: Optional[httpx.AsyncClient] = None
+        # 请求体中与 query/tag 无关的静态部分只构造一次，每次检索仅替换 query 与 searchTagFilter
+        self._body_template: Dict[str, Any] = {
+            "query": "",
+            "userId": user_id,
+            "searchTagFilter": [],
+            "sort": "relevance",
+            "searchType": "normal",
+            "matchFields": ["title", "content", "attachTitles", "attachContent"],
+            "ps": 10,
+            "pn": 1,
+            "categoryFilter": "全行-部门事务-工作手册",
+        }
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """懒加载 HTTP 客户端，整个客户端生命周期内复用同一个连接池"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout_seconds,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        """关闭 HTTP 连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def search(self, query: str, tag: Optional[str]) -> List[Dict[str, Any]]:
         """调用检索接口
@@ -36,61 +64,46 @@ class ReqSearchClient:
             List[Dict[str, Any]]: 检索切片列表（最小加工后的结构：title/content）
         """
         retrival_url = self.base_url
-        user_id = self.user_id
 
         headers = {"Jumpcloud-Env": "BASE"}
 
-        req_data = {
-            "REQ_MESSAGE": json.dumps(
-                {
-                    "REQ_HEAD": {"TRAN_PROCESS": "searchSlicing"},
-                    "REQ_BODY": {
-                        "body": {
-                            "query": query,
-                            "userId": user_id,
-                            # 旧逻辑：tag 为空时默认写死 "数据中心"（保持兼容）
-                            **({"searchTagFilter": [tag]} if tag else {"searchTagFilter": ["数据中心"]}),
-                            "sort": "relevance",
-                            "searchType": "normal",
-                            "matchFields": ["title", "content", "attachTitles", "attachContent"],
-                            "ps": 10,
-                            "pn": 1,
-                            "categoryFilter": "全行-部门事务-工作手册",
-                        }
-                    },
-                }
-            )
+        # 在模板的浅拷贝上替换 query/tag，模板本身不被修改（并发请求安全）
+        body = {
+            **self._body_template,
+            "query": query,
+            # 旧逻辑：tag 为空时默认写死 "数据中心"（保持兼容）
+            "searchTagFilter": [tag] if tag else ["数据中心"],
         }
+        message = {"REQ_HEAD": {"TRAN_PROCESS": "searchSlicing"}, "REQ_BODY": {"body": body}}
+        # 请求体保持 stdlib json 的编码（ASCII + \uXXXX 转义、默认分隔符），与行方接口既有协议一致
+        req_data = {"REQ_MESSAGE": json.dumps(message)}
 
         # 打印请求体用于排查：但注意不要打印敏感信息（此处 userId/base_url 在配置中）
-        try:
+        # INFO 关闭时不做格式化序列化
+        if logger.isEnabledFor(logging.INFO):
             logger.info(
                 "[req_client] search request | url=%s | payload=%s",
                 retrival_url,
-                json.dumps(json.loads(req_data["REQ_MESSAGE"]), indent=2, ensure_ascii=False),
+                orjson.dumps(message, option=orjson.OPT_INDENT_2).decode("utf-8"),
             )
-        except Exception:
-            logger.info("[req_client] search request | url=%s | payload=<unserializable>", retrival_url)
 
         if not retrival_url:
             logger.warning("[req_client] base_url is empty, return []")
             return []
 
         try:
-            # 注意：requests 是同步调用，这里会阻塞事件循环（保持旧实现以最大化兼容）
-            response = requests.post(
+            response = await self.http.post(
                 retrival_url,
                 headers=headers,
                 data=req_data,
-                timeout=self.timeout_seconds,
             )
             response.raise_for_status()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error("[req_client] request failed | err=%s", e, exc_info=True)
             return []
 
         try:
-            response_json = response.json()
+            response_json = orjson.loads(response.content)
         except Exception as e:
             logger.error("[req_client] response not json | err=%s | text=%s", e, response.text[:500], exc_info=True)
             return []
@@ -1,5 +1,4 @@
 from typing import TypedDict, List, Optional, Dict, Any
-from langchain_core.messages import BaseMessage
 
 
 class DomainContext(TypedDict, total=False):
@@ -37,7 +36,6 @@ class RAGState(TypedDict, total=False):
 
     与 `common_qa` 的核心差异：
     - 增加了 query 解析/改写/检索/参考来源等字段。
-    - `history_messages` 由 agent 层注入，保证持久化/历史逻辑与 `common_qa` 一致。
     """
 
     # 依赖注入/配置
@@ -45,7 +43,6 @@ class RAGState(TypedDict, total=False):
 
     # 上下文
     domain_context: Optional[DomainContext]
-    history_messages: List[BaseMessage]
 
     # 输入与解析
     raw_input: str
@@ -64,6 +61,7 @@ class RAGState(TypedDict, total=False):
     answer_source: Optional[str]  # kb | llm_fallback
 
     # 其他
+    enable_streaming: bool  # stream 入口为 True，invoke 入口为 False（回答节点据此选择 astream/ainvoke）
     metadata: Optional[Dict[str, Any]]
     error: Optional[str]
 
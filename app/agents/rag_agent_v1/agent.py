@@ -1,8 +1,10 @@
+import asyncio
 import logging
 import json
 import os
-from typing import Dict, Any, AsyncGenerator
+from typing import Dict, Any, AsyncGenerator, Set
 from langgraph.graph import StateGraph
+from sqlalchemy import insert
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 from app.agents.base import AgentBase
@@ -17,6 +19,23 @@ from app.core.models import SharedConversationHistory
 
 logger = logging.getLogger(__name__)
 
+# 会话历史写入走 Core insert（不构造 ORM 实例），语句只构造一次并复用
+_INSERT_HISTORY = insert(SharedConversationHistory)
+
+_STREAM_QUEUE_MAXSIZE = 64
+_STREAM_EOF = object()
+
+
+async def _pump_graph_events(graph, initial_state: Dict[str, Any], queue: asyncio.Queue) -> None:
+    """生产者：迭代图事件放入队列，正常结束放入 _STREAM_EOF，异常原样转交给消费方"""
+    try:
+        async for event in graph.astream_events(initial_state, version="v2"):
+            await queue.put(event)
+    except Exception as e:
+        await queue.put(e)
+    else:
+        await queue.put(_STREAM_EOF)
+
 
 class RAGAgent(AgentBase):
     """通识问答智能体"""
@@ -30,12 +49,64 @@ class RAGAgent(AgentBase):
         self._req_client: ReqSearchClient | None = None
         self.chat_history = None
         self._system_prompt: str | None = None
+        # 流式回答的后台持久化任务（保留引用，关闭时等待完成）
+        self._bg_tasks: Set[asyncio.Task] = set()
 
     async def _ensure_chat_history(self):
         """确保 chat_history 已初始化"""
         if self.chat_history is None:
             self.chat_history = await get_chat_history_manager()
     
+    def _spawn_background(self, coro) -> None:
+        """以后台任务执行持久化，保留引用直到完成，关闭时统一等待"""
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+
+    async def shutdown(self) -> None:
+        """等待后台持久化任务完成，并关闭检索客户端的连接池"""
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        if self._req_client is not None:
+            await self._req_client.aclose()
+
+    async def _persist_stream_reply(
+            self,
+            thread_id: str,
+            message: str,
+            context: Dict[str, Any],
+            formatted_message: str,
+            final_state: Dict[str, Any],
+    ) -> None:
+        """流式回答结束后保存 Redis 历史并持久化AI回复（后台任务，不阻塞元数据下发）"""
+        try:
+            await self.chat_history.add_message(thread_id, HumanMessage(content=message))
+            await self.chat_history.add_message(thread_id, AIMessage(content=formatted_message))
+        except Exception as e:
+            logger.error(f"Redis 保存对话历史失败（流式）: {e}")
+
+        # ========== 持久化AI回复（共享表） ==========
+        try:
+            mysql = self.get_service("mysql")
+            if mysql:
+                async with mysql.get_session() as session:
+                    ai_row = dict(
+                        thread_id=thread_id,
+                        agent_name=self.name,
+                        role="assistant",
+                        content=formatted_message,
+                        extra_metadata=json.dumps({
+                            "tag": context.get("tag") if context else None,
+                            "rewritten_query": final_state.get("rewritten_query"),
+                            "can_answer": final_state.get("can_answer")
+                        })
+                    )
+                    await session.execute(_INSERT_HISTORY, ai_row)
+                    await session.commit()
+                    logger.debug("MySQL: AI回复已保存到共享表（流式）")
+        except Exception as e:
+            logger.error(f"MySQL 保存AI回复失败（流式）: {e}")
+
     @property
     def system_prompt(self):
         """懒加载系统提示词"""
@@ -73,7 +144,7 @@ class RAGAgent(AgentBase):
         context = context or {}     # 默认为空字典
         # 确保 chat_history 已初始化
         await self._ensure_chat_history()
-        logger.debug(f"========== 传入的content:{context} ==============")
+        logger.debug("========== 传入的content:%s ==============", context)
         is_new_conversation = context.get('is_new_conversation', False)
         # ========== 持久化用户消息（共享表） ==========
         # MySQL: 保存用户消息到共享表
@@ -81,14 +152,14 @@ class RAGAgent(AgentBase):
             mysql = self.get_service("mysql")
             if mysql:
                 async with mysql.get_session() as session:
-                    user_msg = SharedConversationHistory(
+                    user_row = dict(
                         thread_id=thread_id,
                         agent_name=self.name,  # 使用 agent_name 区分不同智能体
                         role="user",
                         content=message,
                         extra_metadata=json.dumps({"tag": context.get("tag")}) if context.get("tag") else None
                     )
-                    session.add(user_msg)
+                    await session.execute(_INSERT_HISTORY, user_row)
                     await session.commit()
                     logger.debug("MySQL: 用户消息已保存到共享表")
         except Exception as e:
@@ -96,7 +167,7 @@ class RAGAgent(AgentBase):
 
         if is_new_conversation:
             history_messages = []
-            logger.debug(f"新对话 (thread_id={thread_id})，跳过历史消息查询")
+            logger.debug("新对话 (thread_id=%s)，跳过历史消息查询", thread_id)
 
         else:
             history_messages = await self.chat_history.get_messages(thread_id)
@@ -144,7 +215,7 @@ class RAGAgent(AgentBase):
             mysql = self.get_service("mysql")
             if mysql:
                 async with mysql.get_session() as session:
-                    ai_msg = SharedConversationHistory(
+                    ai_row = dict(
                         thread_id=thread_id,
                         agent_name=self.name,  # 使用 agent_name 区分不同智能体
                         role="assistant",
@@ -157,7 +228,7 @@ class RAGAgent(AgentBase):
                             }
                         )
                     )
-                    session.add(ai_msg)
+                    await session.execute(_INSERT_HISTORY, ai_row)
                     await session.commit()
                     logger.debug("MySQL: AI回复已保存到共享表")
         except Exception as e:
@@ -191,14 +262,14 @@ class RAGAgent(AgentBase):
             mysql = self.get_service("mysql")
             if mysql:
                 async with mysql.get_session() as session:
-                    user_msg = SharedConversationHistory(
+                    user_row = dict(
                         thread_id=thread_id,
                         agent_name=self.name,
                         role="user",
                         content=message,
                         extra_metadata=json.dumps(context) if context else None
                     )
-                    session.add(user_msg)
+                    await session.execute(_INSERT_HISTORY, user_row)
                     await session.commit()
                     logger.debug("MySQL: 用户消息已保存到共享表（流式）")
         except Exception as e:
@@ -209,7 +280,7 @@ class RAGAgent(AgentBase):
         is_new_conversation = context and context.get('is_new_conversation', False)
         if is_new_conversation:
             history_messages = []
-            logger.debug(f"新对话 (thread_id={thread_id})，跳过历史消息查询（流式）")
+            logger.debug("新对话 (thread_id=%s)，跳过历史消息查询（流式）", thread_id)
         else:
             history_messages = await self.chat_history.get_messages(thread_id)
 
@@ -228,75 +299,124 @@ class RAGAgent(AgentBase):
 
         graph = self.get_graph()
         
-        # 用于存储最终结果和流式输出
-        full_response = ""
+        # 用于存储最终结果和流式输出（token 收集到列表，结束时一次拼接）
+        response_parts = []
         final_state = None
         answer_streaming_completed = False
         stream_ended = False
+        # 相邻的小 token 合并后再下发：累计达到字节数或距上次下发超过间隔时下发，流结束时下发剩余部分
+        coalesce_bytes = int(self.config.get("STREAM_COALESCE_BYTES", 64))
+        coalesce_interval = float(self.config.get("STREAM_COALESCE_INTERVAL", 0.02))
+        pending = []
+        pending_len = 0
+        loop = asyncio.get_running_loop()
+        last_flush = loop.time()
         try:
-            # 使用astream_events实现真正的流式输出
-            async for event in graph.astream_events(
-                initial_state,
-                version="v2"
-            ):
-                # 记录事件类型与关键信息，便于排查最终 output 的结构
-                try:
-                    evt_type = event.get("event")
-                    evt_data = event.get("data") or {}
-                    out = evt_data.get("output") if isinstance(evt_data, dict) else None
-                    if isinstance(out, dict):
-                        out_keys = list(out.keys())
+            # 使用astream_events实现真正的流式输出：独立任务读取图事件放入有界队列，
+            # 消费方据此在模型停顿时也能按间隔下发已缓冲的 token
+            queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_MAXSIZE)
+            producer = asyncio.create_task(_pump_graph_events(graph, initial_state, queue))
+            try:
+                while True:
+                    if pending:
+                        # 有未下发的 token 时最多等到本轮间隔结束，超时即下发，避免模型停顿时尾部 token 滞留
+                        timeout = last_flush + coalesce_interval - loop.time()
+                        try:
+                            if timeout > 0:
+                                event = await asyncio.wait_for(queue.get(), timeout)
+                            else:
+                                event = queue.get_nowait()
+                        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                            yield {
+                                "type": "message",
+                                "data": "".join(pending)
+                            }
+                            pending.clear()
+                            pending_len = 0
+                            last_flush = loop.time()
+                            continue
                     else:
-                        out_keys = type(out)
-                    logger.debug("[stream] event=%s, data_keys=%s, output_keys=%s", evt_type, list(evt_data.keys()) if isinstance(evt_data, dict) else None, out_keys)
-                except Exception as _:
-                    logger.debug("[stream] event debug failed")
+                        event = await queue.get()
+
+                    if event is _STREAM_EOF:
+                        break
+                    if isinstance(event, Exception):
+                        raise event
+                    # 记录事件类型与关键信息，便于排查最终 output 的结构（仅 DEBUG 级别时构建参数）
+                    if logger.isEnabledFor(logging.DEBUG):
+                        try:
+                            evt_type = event.get("event")
+                            evt_data = event.get("data") or {}
+                            out = evt_data.get("output") if isinstance(evt_data, dict) else None
+                            if isinstance(out, dict):
+                                out_keys = list(out.keys())
+                            else:
+                                out_keys = type(out)
+                            logger.debug("[stream] event=%s, data_keys=%s, output_keys=%s", evt_type, list(evt_data.keys()) if isinstance(evt_data, dict) else None, out_keys)
+                        except Exception as _:
+                            logger.debug("[stream] event debug failed")
                 
-                # 处理LLM流式输出
-                if event["event"] == "on_chat_model_stream":
-                    try:
-                        chunk_data = event["data"]["chunk"]
+                    # 处理LLM流式输出
+                    if event["event"] == "on_chat_model_stream":
+                        try:
+                            chunk_data = event["data"]["chunk"]
                         
-                        if chunk_data is None:
-                            continue
+                            if chunk_data is None:
+                                continue
                         
-                        if hasattr(chunk_data, "content"):
-                            content = chunk_data.content
-                        else:
-                            try:
-                                content = str(chunk_data)
-                            except:
-                                content = ""
+                            if hasattr(chunk_data, "content"):
+                                content = chunk_data.content
+                            else:
+                                try:
+                                    content = str(chunk_data)
+                                except:
+                                    content = ""
                         
-                        if content:
-                            full_response += content
-                            yield {
-                                "type": "message",
-                                "data": content
-                            }
-                    except Exception as e:
-                        logger.warning(f"[stream] 处理chunk出错: {e}")
-                        continue
-                
-                # 获取最终状态结果
-                elif event["event"] == "on_end":
-                    final_state = event["data"].get("output")
-                    # 记录 final_state 的简要内容，确认 retrieved/references 是否保留
-                    try:
-                        if final_state:
-                            logger.debug("[stream] on_end final_state keys=%s", list(final_state.keys()))
-                            logger.debug("[stream] on_end retrieved preview=%s", (final_state.get("retrieved") or [])[:2])
-                            logger.debug("[stream] on_end references preview=%s", (final_state.get("references") or [])[:2])
-                        else:
-                            logger.debug("[stream] on_end final_state is None or empty")
-                    except Exception as e:
-                        logger.debug("[stream] logging final_state failed: %s", e)
-                    answer_streaming_completed = True
-                    stream_ended = True
+                            if content:
+                                response_parts.append(content)
+                                pending.append(content)
+                                pending_len += len(content)
+                                now = loop.time()
+                                if pending_len >= coalesce_bytes or now - last_flush >= coalesce_interval:
+                                    yield {
+                                        "type": "message",
+                                        "data": "".join(pending)
+                                    }
+                                    pending.clear()
+                                    pending_len = 0
+                                    last_flush = now
+                        except Exception as e:
+                            logger.warning(f"[stream] 处理chunk出错: {e}")
+                            continue
                 
+                    # 获取最终状态结果
+                    elif event["event"] == "on_end":
+                        final_state = event["data"].get("output")
+                        # 记录 final_state 的简要内容，确认 retrieved/references 是否保留（仅 DEBUG 级别时构建参数）
+                        if logger.isEnabledFor(logging.DEBUG):
+                            try:
+                                if final_state:
+                                    logger.debug("[stream] on_end final_state keys=%s", list(final_state.keys()))
+                                    logger.debug("[stream] on_end retrieved preview=%s", (final_state.get("retrieved") or [])[:2])
+                                    logger.debug("[stream] on_end references preview=%s", (final_state.get("references") or [])[:2])
+                                else:
+                                    logger.debug("[stream] on_end final_state is None or empty")
+                            except Exception as e:
+                                logger.debug("[stream] logging final_state failed: %s", e)
+                        answer_streaming_completed = True
+                        stream_ended = True
+            finally:
+                producer.cancel()
+
+            if pending:
+                yield {
+                    "type": "message",
+                    "data": "".join(pending)
+                }
 
             # ========== 流式输出完成后，拼接参考来源 ==========
             if answer_streaming_completed:
+                full_response = "".join(response_parts)
                 # 获取检索结果
                 retrieved = final_state.get("retrieved") if final_state else []
                 
@@ -323,31 +443,11 @@ class RAGAgent(AgentBase):
                 else:
                     formatted_message = f"\n{full_response}"
                     
-                # 保存对话历史到 Redis
-                await self.chat_history.add_message(thread_id, HumanMessage(content=message))
-                await self.chat_history.add_message(thread_id, AIMessage(content=formatted_message))
-
-                # ========== 持久化AI回复（共享表） ==========
-                try:
-                    mysql = self.get_service("mysql")
-                    if mysql:
-                        async with mysql.get_session() as session:
-                            ai_msg = SharedConversationHistory(
-                                thread_id=thread_id,
-                                agent_name=self.name,
-                                role="assistant",
-                                content=formatted_message,
-                                extra_metadata=json.dumps({
-                                    "tag": context.get("tag") if context else None,
-                                    "rewritten_query": final_state.get("rewritten_query"),
-                                    "can_answer": final_state.get("can_answer")
-                                })
-                            )
-                            session.add(ai_msg)
-                            await session.commit()
-                            logger.debug("MySQL: AI回复已保存到共享表（流式）")
-                except Exception as e:
-                    logger.error(f"MySQL 保存AI回复失败（流式）: {e}")
+                # Redis/MySQL 持久化转到后台执行，元数据无需等待写入即可下发
+                # （先创建任务再 yield：客户端在收到元数据后断开也不会丢失本轮历史）
+                self._spawn_background(
+                    self._persist_stream_reply(thread_id, message, context, formatted_message, final_state)
+                )
 
                 # 发送元数据
                 yield {
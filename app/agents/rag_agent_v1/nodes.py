@@ -1,12 +1,8 @@
 import logging
 import os
-import re
 from typing import Any, Dict, List
-import json
 
 from langchain_core.messages import SystemMessage, HumanMessage
-from pandas.core.arrays.arrow import ListAccessor
-from pyexpat.errors import messages
 
 from .state import RAGState
 
@@ -49,7 +45,7 @@ async def parse_input_node(state: RAGState) -> RAGState:
     domain_context = {"last_query":query_text}
 
     logger.info("[parse_input_node]tag=%s | query=%s",tag,query_text)
-    return {**state, "parsed_query": query_text, "tag": tag, "domain_context": domain_context}
+    return state | {"parsed_query": query_text, "tag": tag, "domain_context": domain_context}
 
 async def rewrite_query_node(state: RAGState) -> RAGState:
     """查询改写"""
@@ -58,7 +54,7 @@ async def rewrite_query_node(state: RAGState) -> RAGState:
 
     if not _llm_service:
         logger.error("[rewrite_query_node]LLM服务未设置")
-        return {**state, "rewritten_query": query_text}
+        return state | {"rewritten_query": query_text}
     global _rewrite_prompt
     if _rewrite_prompt is None:
         _rewrite_prompt = _load_prompt("rewrite_query.md")
@@ -81,8 +77,7 @@ async def rewrite_query_node(state: RAGState) -> RAGState:
     domain_context = state.get("domain_context") or {}
     domain_context.update({"last_query": rewritten_query})
 
-    return {
-        **state,
+    return state | {
         "rewritten_query": rewritten_query,
         "domain_context": domain_context
     }
@@ -97,11 +92,11 @@ async def req_search_node(state: RAGState) -> RAGState:
 
     if not _req_client:
         logger.error("[req_search_node]req_client服务未设置")
-        return {**state, "retrieved":[]}
+        return state | {"retrieved":[]}
 
     slices = await _req_client.search(query_text, tag)
     logger.debug("[req_search_node]检索的结果：%s", slices)
-    return {**state, "retrieved": slices}
+    return state | {"retrieved": slices}
 
 
 
@@ -123,7 +118,7 @@ async def preprocess_results_node(state: RAGState) -> RAGState:
                 "snippet": item.get("para")
             }
         )
-    return {**state,"references": references, "retrieved": retrieved}
+    return state | {"references": references, "retrieved": retrieved}
 async def judge_answerable_node(state: RAGState) -> RAGState:
     """判断是否能回答，可能取消该节点, 暂时为简易实现,不调大模型
     如果有检索内容，则回答来源为kb，否则为llm_fallback
@@ -138,8 +133,7 @@ async def judge_answerable_node(state: RAGState) -> RAGState:
     except Exception:
         logger.debug("[judge_answerable_node] 无法获取 retrieved 预览")
     logger.debug("[judge_answerable_node]正在执行，answer_source=%s", answer_source)
-    return {
-        **state,
+    return state | {
         "can_answer": can_answer,
         "fallback_reason": fallback_reason,
         "answer_source": answer_source
@@ -176,8 +170,7 @@ async def compose_answer_node(state: RAGState) -> RAGState:
         answer = _llm_service.clean_response(resp_content)
         # 保持原始的 retrieved 信息，不要在回退路径中清空，便于后续处理和记录参考来源
         logger.debug("[compose_answer_node] llm_fallback, preserved retrieved count=%s", len(state.get("retrieved") or []))
-        return {
-            **state,
+        return state | {
             "answer": answer,
             "references": state.get("references") or [],
             "retrieved": state.get("retrieved") or [],
@@ -218,4 +211,4 @@ async def compose_answer_node(state: RAGState) -> RAGState:
             logger.warning("[compose_answer_node] 普通调用也失败，使用参考文段代替: %s", e2)
             answer = retrieved or "未检索到相关内容"
 
-    return {**state, "answer": answer, "answer_source": "kb", "retrieved": retrieved}
+    return state | {"answer": answer, "answer_source": "kb", "retrieved": retrieved}
@@ -3,9 +3,9 @@
 import json
 import logging
 from typing import List, Dict, Any, Optional
-import requests
-import re
-import os
+
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +14,23 @@ class ReqSearchClient:
     def __init__(self, base_url: str, timeout_seconds: int = 8):
         self.base_url = base_url
         self.timeout_seconds = timeout_seconds
+        self._http: Optional[httpx.AsyncClient] = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """懒加载 HTTP 客户端，复用同一个连接池（不阻塞事件循环）"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout_seconds,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        """关闭 HTTP 连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def search(self, query: str, tag: Optional[str]) -> List[Dict[str, Any]]:
 
@@ -49,13 +66,14 @@ class ReqSearchClient:
 
         logger.info(f"检索请求体: {json.dumps(json.loads(req_data['REQ_MESSAGE']), indent=2, ensure_ascii=False)}")
         try:
-            response = requests.post(retrival_url, headers=headers, data=req_data)
+            response = await self.http.post(retrival_url, headers=headers, data=req_data)
             response.raise_for_status()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"发送请求时出错: {e}")
             return []
 
-        response_json = response.json()
+        # 完整上下文版本响应体较大（含 paraItems），用 orjson 直接解析字节
+        response_json = orjson.loads(response.content)
         status = response_json["RSP_BODY"]["status"]
         logger.info(f"检索工具状态: {status}")
 
@@ -96,19 +114,23 @@ class ReqSearchClient:
                     if not para_content.strip():
                         continue
 
+                    # nid 形如 "<guid>_text_<n>" / "<guid>_table_<n>"，按 "_" 拆出类型与序号（不走正则）
+                    head, _, index_str = nid.rpartition("_")
+                    if not index_str.isdigit():
+                        continue
+                    chunk_kind = head.rpartition("_")[2]
+
                     # 处理text类型的nid
-                    text_match = re.search(r"text_(\d+)", nid)
-                    if text_match:
-                        chunk_index = int(text_match.group(1))
+                    if chunk_kind == "text":
+                        chunk_index = int(index_str)
                         # 去重，保留每个chunk序号对应的内容
                         if chunk_index not in grouped_items[title]["text_chunks"]:
                             grouped_items[title]["text_chunks"][chunk_index] = para_content
                         continue
 
                     # 处理table类型的nid
-                    table_match = re.search(r"table_(\d+)", nid)
-                    if table_match:
-                        chunk_index = int(table_match.group(1))
+                    if chunk_kind == "table":
+                        chunk_index = int(index_str)
                         # 每个table作为一个独立的片段
                         grouped_items[title]["table_chunks"][chunk_index] = para_content
 
@@ -124,36 +146,24 @@ class ReqSearchClient:
                 continue
 
             content_parts = []
+            # 每个 title 独立编号，table 片段接在 text 片段之后
+            segments: List[List[str]] = []
 
-            # 处理text类型的chunks
+            # 处理text类型的chunks：按序号排序后一次遍历，序号连续的 chunk 合并到同一片段
             if item_data["text_chunks"]:
-                # 按chunk序号排序
-                sorted_text_chunks = sorted(item_data["text_chunks"].items())
-
-                # 将连续的chunk合并为片段
-                segments = []
-                if sorted_text_chunks:
-                    current_segment = [sorted_text_chunks[0]]
-
-                    for i in range(1, len(sorted_text_chunks)):
-                        prev_index = sorted_text_chunks[i - 1][0]
-                        curr_index = sorted_text_chunks[i][0]
-
-                        # 如果当前chunk与前一个chunk序号连续，则合并到同一个片段
-                        if curr_index == prev_index + 1:
-                            current_segment.append(sorted_text_chunks[i])
-                        else:
-                            # 否则，结束当前片段，开始新片段
-                            segments.append(current_segment)
-                            current_segment = [sorted_text_chunks[i]]
-
-                    # 添加最后一个片段
-                    segments.append(current_segment)
+                prev_index = -2
+                current_segment: List[str] = []
+                for chunk_index, chunk_content in sorted(item_data["text_chunks"].items()):
+                    if chunk_index != prev_index + 1:
+                        current_segment = []
+                        segments.append(current_segment)
+                    current_segment.append(chunk_content)
+                    prev_index = chunk_index
 
                 # 按指定格式构建text内容
                 for i, segment in enumerate(segments):
                     # 合并同一个片段中的所有chunk内容
-                    segment_content = "".join([chunk[1] for chunk in segment])
+                    segment_content = "".join(segment)
                     # 只有当片段内容不为空时才添加
                     if segment_content.strip():
                         content_parts.append(f":::card 片段{i + 1}\n{segment_content}\n:::")
@@ -161,10 +171,9 @@ class ReqSearchClient:
             # 处理table类型的chunks
             if item_data["table_chunks"]:
                 # table类型的chunks每个都是独立的片段
-                sorted_table_chunks = sorted(item_data["table_chunks"].items())
-                start_index = len(segments) if 'segments' in locals() else 0  # table片段的起始编号
+                start_index = len(segments)  # table片段的起始编号
 
-                for i, (chunk_index, chunk_content) in enumerate(sorted_table_chunks):
+                for i, (chunk_index, chunk_content) in enumerate(sorted(item_data["table_chunks"].items())):
                     if chunk_content.strip():
                         content_parts.append(f":::card 片段{start_index + i + 1}\n{chunk_content}\n\n:::")
 
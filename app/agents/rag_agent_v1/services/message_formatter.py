@@ -31,5 +31,5 @@ def format_response_message(answer: str, references: List[Dict[str, Any]]) -> st
 
     # 拼接答案和参考资料
     formatted_message = f"\n{answer}\n\n:::card 参考来源\n{references_str}\n:::"
-    logger.debug(f"[format_response_message] formatted_message: {formatted_message}")
+    logger.debug("[format_response_message] formatted_message: %s", formatted_message)
     return formatted_message
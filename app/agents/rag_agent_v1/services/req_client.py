@@ -2,9 +2,9 @@
 import json
 import logging
 from typing import List, Dict, Any, Optional
-import requests
-import re
-import os
+
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -14,46 +14,72 @@ class ReqSearchClient:
         self.base_url = base_url
         self.user_id = user_id
         self.timeout_seconds = timeout_seconds
+        self._http: Optional[httpx.AsyncClient] = None
+        # 请求体静态部分只构造一次，每次检索仅替换 query 与 searchTagFilter
+        self._body_template: Dict[str, Any] = {
+            "query": "",
+            "userId": user_id,
+            "searchTagFilter": [],
+            "sort": "relevance",
+            "searchType": "normal",
+            "matchFields": ["title", "content", "attachTitles", "attachContent"],
+            "ps": 10,
+            "pn": 1,
+            "categoryFilter": "全行-部门事务-工作手册"
+        }
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """懒加载 HTTP 客户端，复用同一个连接池（不阻塞事件循环）"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout_seconds,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        """关闭 HTTP 连接池"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def search(self, query: str, tag: Optional[str]) -> List[Dict[str, Any]]:
 
         retrival_url = self.base_url
-        userId = self.user_id
         headers = {
             "Jumpcloud-Env": "BASE"
         }
 
+        # 在模板的浅拷贝上替换 query/tag，模板本身不被修改
+        body = {
+            **self._body_template,
+            "query": query,
+            "searchTagFilter": [tag] if tag else ["数据中心"]
+        }
+        message = {
+            "REQ_HEAD": {
+                "TRAN_PROCESS": "searchSlicing"
+            },
+            "REQ_BODY": {
+                "body": body
+            }
+        }
         req_data = {
-            "REQ_MESSAGE": json.dumps({
-                "REQ_HEAD": {
-                    "TRAN_PROCESS": "searchSlicing"
-                },
-                "REQ_BODY": {
-                    "body": {
-                        "query": query,
-                        "userId": userId, #"5000259879",
-                        #**({"searchTagFilter": [tag]} if tag else {}),
-                        **({"searchTagFilter": [tag]} if tag else {"searchTagFilter": ["数据中心"]}),
-                        "sort": "relevance",
-                        "searchType": "normal",
-                        "matchFields": ["title", "content", "attachTitles", "attachContent"],
-                        "ps": 10,
-                        "pn": 1,
-                        "categoryFilter": "全行-部门事务-工作手册"
-                    }
-                }
-            })
+            "REQ_MESSAGE": json.dumps(message)
         }
 
-        logger.info(f"检索请求体: {json.dumps(json.loads(req_data['REQ_MESSAGE']), indent=2, ensure_ascii=False)}")
+        # INFO 关闭时不做格式化序列化
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("检索请求体: %s", orjson.dumps(message, option=orjson.OPT_INDENT_2).decode("utf-8"))
         try:
-            response = requests.post(retrival_url, headers=headers, data=req_data)
+            response = await self.http.post(retrival_url, headers=headers, data=req_data)
             response.raise_for_status()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"发送请求时出错: {e}")
             return []
 
-        response_json = response.json()
+        response_json = orjson.loads(response.content)
         status = response_json["RSP_BODY"]["status"]
         logger.info(f"检索工具状态: {status}")
 
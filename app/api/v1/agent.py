@@ -111,20 +111,15 @@ async def stream_agent(request: AgentStreamRequest):
                     event_data = chunk.get("data", "")
                     
                     # SSE 格式: event: type\ndata: json_data\n\n
-                    yield f"event: {event_type}\n"
-                    yield f"data: {json.dumps(event_data, ensure_ascii=False)}\n\n"
-                    
-                    # 确保数据立即发送
-                    await asyncio.sleep(0)
+                    # event 行与 data 行合并为一帧输出，每个事件只产生一次写出
+                    yield f"event: {event_type}\ndata: {json.dumps(event_data, ensure_ascii=False)}\n\n"
                 
                 # 发送完成信号
-                yield "event: done\n"
-                yield f"data: {json.dumps({'thread_id': thread_id})}\n\n"
+                yield f"event: done\ndata: {json.dumps({'thread_id': thread_id})}\n\n"
                 
             except Exception as e:
                 # 发送错误信号
-                yield "event: error\n"
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
         
         return StreamingResponse(
             event_generator(),
@@ -12,6 +12,9 @@ import yaml
 
 from app.agents.registry import AgentRegistry
 from app.agents.loader import AgentLoader
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
 
 router = APIRouter(prefix="/api/v1/agent-management", tags=["agent-management"])
 
@@ -245,11 +248,21 @@ async def reload_agents():
         重新加载结果
     """
     try:
+        # 释放旧智能体：清除编译图缓存（否则旧模块与服务会一直被缓存引用），
+        # 并关闭其持有的 HTTP 连接池、等待后台持久化任务完成
+        for agent_name in AgentRegistry.list_agents():
+            agent = AgentRegistry.get(agent_name)
+            agent.invalidate_graph()
+            try:
+                await agent.shutdown()
+            except Exception as e:
+                logger.warning(f"智能体 [{agent_name}] 关闭失败: {e}")
+
         # 清空注册中心
         AgentRegistry.clear()
         
         # 重新加载所有智能体
-        AgentLoader.load_all_agents()
+        AgentLoader.load_all_agents(reload=True)
         
         # 获取已加载的智能体
         loaded_agents = AgentRegistry.list_agents()
@@ -64,12 +64,32 @@ class ChatHistoryManager:
     async def add_messages(self, thread_id: str, messages: List[BaseMessage]) -> None:
         """批量添加消息到会话历史
         
+        一次 RPUSH 写入全部消息，与 EXPIRE 合并在同一个 pipeline 中，只产生一次网络往返。
+        
         Args:
             thread_id: 会话ID
             messages: 消息列表
         """
-        for message in messages:
-            await self.add_message(thread_id, message)
+        if not messages:
+            return
+        try:
+            key = self._get_key(thread_id)
+            
+            # 将消息序列化
+            values = [
+                json.dumps({"type": message.__class__.__name__, "content": message.content}, ensure_ascii=False)
+                for message in messages
+            ]
+            
+            # 添加到Redis列表并设置过期时间(7天)
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(key, *values)
+                pipe.expire(key, 7 * 24 * 60 * 60)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"批量添加消息到 Redis 失败: {e}")
+            self._is_healthy = False
+            raise
 
     async def _get_from_redis(self, thread_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
         """从 Redis 获取会话历史消息
@@ -230,8 +250,8 @@ class ChatHistoryManager:
         Returns:
             消息列表
         """
-        # 1. 先尝试从 Redis 读取
-        messages = await self._get_from_redis(thread_id, limit=None)
+        # 1. 先尝试从 Redis 读取（指定 limit 时只取尾部窗口，LRANGE -N -1）
+        messages = await self._get_from_redis(thread_id, limit=limit)
         
         # 2. 如果 Redis 为空，尝试从数据库恢复
         if not messages:
@@ -249,7 +269,7 @@ class ChatHistoryManager:
                 logger.info(f"从数据库恢复了 {len(messages)} 条历史记录，正在回写到 Redis...")
                 await self._restore_to_redis(thread_id, messages)
             else:
-                logger.debug(f"数据库中也未找到历史记录 (thread_id={thread_id})")
+                logger.debug("数据库中也未找到历史记录 (thread_id=%s)", thread_id)
         
         # 3. 如果指定了 limit，截取最后 N 条
         if limit and len(messages) > limit:
@@ -506,7 +526,7 @@ class MemoryChatHistoryManager:
     async def get_messages(self, thread_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
         """获取会话历史消息（带数据库回退）"""
         # 1. 先尝试从内存读取
-        messages = await self._get_from_memory(thread_id, limit=None)
+        messages = await self._get_from_memory(thread_id, limit=limit)
         
         # 2. 如果内存为空，尝试从数据库恢复
         if not messages:
@@ -524,7 +544,7 @@ class MemoryChatHistoryManager:
                 logger.info(f"从数据库恢复了 {len(messages)} 条历史记录，正在回写到内存...")
                 await self._restore_to_memory(thread_id, messages)
             else:
-                logger.debug(f"数据库中也未找到历史记录 (thread_id={thread_id})")
+                logger.debug("数据库中也未找到历史记录 (thread_id=%s)", thread_id)
         
         # 3. 如果指定了 limit，截取最后 N 条
         if limit and len(messages) > limit:
@@ -34,6 +34,7 @@ class Settings(BaseSettings):
     mysql_password: str = ""
     mysql_database: str = "agentflow"
     mysql_pool_size: int = 10
+    mysql_max_overflow: int = 20
     mysql_pool_recycle: int = 3600
 
     # MongoDB 配置（可选）
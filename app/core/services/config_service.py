@@ -83,7 +83,7 @@ class ConfigService(IService, IConfigService):
             value: 配置值
         """
         self._runtime_config[key] = value
-        logger.debug(f"运行时配置已设置: {key} = {value}")
+        logger.debug("运行时配置已设置: %s = %s", key, value)
     
     def get_settings(self):
         """获取原始 settings 对象
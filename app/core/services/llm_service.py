@@ -13,6 +13,10 @@ from .interfaces import ILLMService, IApiKeyService
 
 logger = logging.getLogger(__name__)
 
+# 思考标签，模块加载时编译一次
+_THINK_PATTERN = re.compile(r'<think>.*?</think>', flags=re.DOTALL)
+_THINKING_PATTERN = re.compile(r'<thinking>.*?</thinking>', flags=re.DOTALL)
+
 
 class LLMService(IService, ILLMService):
     """LLM 服务实现
@@ -97,7 +101,7 @@ class LLMService(IService, ILLMService):
             temperature=temperature
         )
         
-        logger.debug(f"创建 LLM 模型实例: {model}_{temperature}_{api_key}")
+        logger.debug("创建 LLM 模型实例: %s_%s_%s", model, temperature, api_key)
         
         return llm
     
@@ -144,11 +148,15 @@ class LLMService(IService, ILLMService):
         Returns:
             清理后的内容
         """
+        # 不含思考标签时（绝大多数回答）跳过正则扫描
+        if '<think' not in content:
+            return content.strip()
+        
         # 移除 <think>...</think> 标签及其内容
-        cleaned = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+        cleaned = _THINK_PATTERN.sub('', content)
         
         # 移除 <thinking>...</thinking> 标签及其内容
-        cleaned = re.sub(r'<thinking>.*?</thinking>', '', cleaned, flags=re.DOTALL)
+        cleaned = _THINKING_PATTERN.sub('', cleaned)
         
         # 去除多余的空白字符
         cleaned = cleaned.strip()
@@ -118,6 +118,8 @@ class MySQLService(IService, IDatabaseService):
         self._engine = create_async_engine(
             connection_string,
             pool_size=settings.mysql_pool_size,
+            # 突发写入（如后台持久化）允许临时超出连接池，避免排队等待连接
+            max_overflow=settings.mysql_max_overflow,
             pool_recycle=settings.mysql_pool_recycle,
             echo=False,  # 设置为 True 可以看到 SQL 日志
             future=True,
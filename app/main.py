@@ -96,6 +96,13 @@ async def lifespan(app: FastAPI):
         logger.info("  未发现任何智能体")
     logger.info("=" * 50)
     
+    # 预热智能体（编译图、初始化客户端），避免首个请求承担初始化耗时
+    for agent_name in agents:
+        try:
+            await AgentRegistry.get(agent_name).warmup()
+        except Exception as e:
+            logger.warning(f"智能体 [{agent_name}] 预热失败，将在首次请求时初始化: {e}")
+    
     # 初始化数据库表和集合
     logger.info("正在初始化数据库...")
     try:
@@ -141,6 +148,13 @@ async def lifespan(app: FastAPI):
     # 关闭
     logger.info("正在关闭多智能体平台...")
     
+    # 释放智能体持有的资源（HTTP 连接池等）
+    for agent_name in AgentRegistry.list_agents():
+        try:
+            await AgentRegistry.get(agent_name).shutdown()
+        except Exception as e:
+            logger.warning(f"智能体 [{agent_name}] 关闭失败: {e}")
+    
     # 关闭所有服务
     if _container is not None:
         await _container.shutdown_all()
@@ -10,5 +10,6 @@ if __name__ == "__main__":
         reload=settings.uvicorn_reload,  # 生产环境应关闭
         log_level="info",
         workers= settings.uvicorn_workers,  # 根据 CPU 核心数调整，建议设置成CPU核心数或者+1
-        loop="asyncio"
+        loop="auto",  # 已安装 uvloop 时自动使用（uvicorn[standard] 在 Windows 上不安装 uvloop）
+        http="httptools"  # uvicorn[standard] 自带 httptools，I/O 密集的流式转发收益明显
     )
\ No newline at end of file